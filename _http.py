@@ -0,0 +1,211 @@
+"""Shared HTTP session, upload, polling and caching helpers for the test scripts."""
+import hashlib
+import os
+import random
+import shelve
+import socket
+import threading
+import time
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# Streaming multipart uploads
+try:
+    from requests_toolbelt import MultipartEncoder
+    STREAMING_UPLOAD_SUPPORT = True
+except ImportError:
+    print("Warning: requests-toolbelt not installed. Uploads will be buffered in memory.")
+    STREAMING_UPLOAD_SUPPORT = False
+
+BASE_URL = "http://localhost:8000"
+# Survives between runs so re-running a script against an unchanged server skips the GETs
+CACHE_PATH = "/tmp/meshmind_test_cache"
+# Off by default so test runs always exercise the server; set MESHMIND_TEST_CACHE=1 to reuse results
+CACHE_ENABLED = os.getenv("MESHMIND_TEST_CACHE") == "1"
+# File most recently uploaded or tested against, so debug scripts can skip /files
+LAST_FILE_ID_PATH = os.path.expanduser("~/.cache/meshmind/last_file_id")
+
+_cache = {}
+# shelve is not safe for concurrent access from the query thread pools
+_cache_lock = threading.Lock()
+
+# Small POSTs go out without waiting on Nagle; idle pooled sockets are kept alive
+SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+class TunedAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled connections use SOCKET_OPTIONS."""
+    
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault("socket_options", SOCKET_OPTIONS)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+def make_session(user_id, header="user-id"):
+    """Create a keep-alive session with retries and the user header set once."""
+    session = requests.Session()
+    adapter = TunedAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Defaults sent on every request; ACCEPT_ENCODING includes br only when brotli can decode it
+    session.headers.update({
+        header: user_id,
+        "Accept-Encoding": ACCEPT_ENCODING,
+        "Connection": "keep-alive",
+    })
+    return session
+
+def remember_file_id(file_id):
+    """Record the file id later runs should default to."""
+    os.makedirs(os.path.dirname(LAST_FILE_ID_PATH), exist_ok=True)
+    with open(LAST_FILE_ID_PATH, "w") as f:
+        f.write(file_id)
+
+def _discover_latest(session, base_url):
+    """Ask the server for the user's newest file id; None if there are none or the request failed."""
+    response = session.get(f"{base_url}/files", params={"sort": "-created_at", "limit": 1})
+    if response.status_code != 200:
+        return None
+    files = response.json()
+    if not files:
+        return None
+    # Servers without sort/limit support return every file: pick the newest in O(n)
+    return max(files, key=lambda f: f.get("created_at", ""))["file_id"]
+
+def resolve_file_id(session, base_url=BASE_URL):
+    """File id to test against: $MESHMIND_FILE_ID, else the last one used, else the newest on the server."""
+    file_id = os.getenv("MESHMIND_FILE_ID")
+    if not file_id and os.path.exists(LAST_FILE_ID_PATH):
+        with open(LAST_FILE_ID_PATH) as f:
+            file_id = f.read().strip()
+    if not file_id:
+        file_id = _discover_latest(session, base_url)
+        if file_id:
+            remember_file_id(file_id)
+    return file_id
+
+def upload_file(session, path, content_type="application/octet-stream", base_url=BASE_URL):
+    """POST a file to /upload, streaming it from disk instead of buffering the whole body."""
+    filename = os.path.basename(path)
+    with open(path, "rb") as f:
+        if not STREAMING_UPLOAD_SUPPORT:
+            response = session.post(f"{base_url}/upload", files={"file": (filename, f, content_type)})
+        else:
+            encoder = MultipartEncoder(fields={"file": (filename, f, content_type)})
+            response = session.post(
+                f"{base_url}/upload",
+                data=encoder,
+                headers={"Content-Type": encoder.content_type}
+            )
+    
+    if response.status_code == 200:
+        remember_file_id(response.json()["file_id"])
+    return response
+
+def poll_status(session, file_id, deadline=60.0, base_url=BASE_URL):
+    """Wait for a file to be processed or failed, long-polling the status endpoint.
+    
+    The server holds each request open until processing finishes (up to 60s), so this
+    usually takes one round-trip. Servers without wait= support answer at once, and the
+    capped exponential backoff between attempts covers them; If-None-Match turns an
+    unchanged status into an empty 304. Returns the last status document, or None if
+    the deadline passed first.
+    """
+    headers = {}
+    stop = time.monotonic() + deadline
+    attempt = 0
+    while time.monotonic() < stop:
+        wait = min(60.0, max(0.0, stop - time.monotonic()))
+        response = session.get(
+            f"{base_url}/file/{file_id}/status",
+            params={"wait": round(wait, 1)},
+            headers=headers,
+            timeout=wait + 10
+        )
+        if response.status_code != 304:
+            status_data = response.json()
+            if "ETag" in response.headers:
+                headers = {"If-None-Match": response.headers["ETag"]}
+            status = status_data.get("status")
+            print(f"   Attempt {attempt+1}: Status = {status}")
+            if status in ("processed", "failed"):
+                return status_data
+        
+        time.sleep(min(4.0, 0.25 * 2 ** attempt) + random.uniform(0, 0.1))
+        attempt += 1
+    return None
+
+def _cache_lookup(key, ttl):
+    """Return a cached value younger than ttl seconds, checking memory before disk."""
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            with shelve.open(CACHE_PATH) as disk:
+                entry = disk.get(key)
+    if entry is not None and time.time() - entry[0] < ttl:
+        _cache[key] = entry
+        return entry[1]
+    return None
+
+def _cache_store(key, value):
+    """Cache a value in memory and on disk."""
+    entry = (time.time(), value)
+    with _cache_lock:
+        _cache[key] = entry
+        with shelve.open(CACHE_PATH) as disk:
+            disk[key] = entry
+    return value
+
+def cached_get(session, url, ttl=30.0):
+    """GET an idempotent JSON endpoint through an in-memory and on-disk TTL cache.
+    
+    Entries are keyed on URL and user; returns the parsed body, or None if the request failed.
+    Without CACHE_ENABLED every call goes to the server.
+    """
+    key = f"{session.headers.get('user-id', '')}|{url}"
+    cached = _cache_lookup(key, ttl) if CACHE_ENABLED else None
+    if cached is not None:
+        return cached
+    
+    response = session.get(url)
+    if response.status_code != 200:
+        return None
+    
+    # orjson decodes large graph payloads several times faster than requests' stdlib json
+    result = orjson.loads(response.content)
+    return _cache_store(key, result) if CACHE_ENABLED else result
+
+def cached_query(session, payload, ttl=900.0, base_url=BASE_URL):
+    """POST /query through the same cache, keyed on the user, payload and file state.
+    
+    The file's status ETag is part of the key, so reprocessing a file misses the cache.
+    Without CACHE_ENABLED every call goes to the server. Returns the parsed result, or
+    None if the request failed.
+    """
+    if not CACHE_ENABLED:
+        response = session.post(f"{base_url}/query", json=payload)
+        return orjson.loads(response.content) if response.status_code == 200 else None
+    
+    status = session.get(f"{base_url}/file/{payload['file_id']}/status")
+    if status.status_code != 200:
+        return None
+    digest = hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    key = f"{session.headers.get('user-id', '')}|query|{status.headers.get('ETag', '')}|{digest}"
+    cached = _cache_lookup(key, ttl)
+    if cached is not None:
+        return cached
+    
+    response = session.post(f"{base_url}/query", json=payload)
+    if response.status_code != 200:
+        return None
+    
+    return _cache_store(key, orjson.loads(response.content))
@@ -1,20 +1,32 @@
 """Simple FastAPI app for PDF processing and chat with knowledge graph support."""
+import io
 import os
 import uuid
-import io
+import asyncio
+import hashlib
+import hmac
 import re
-import json
+import functools
+import multiprocessing
+from collections import OrderedDict, namedtuple
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict, List, Optional, Any, Set, Tuple
 from datetime import datetime
 
-from fastapi import FastAPI, File, UploadFile, Form, Header, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, Form, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
+import aiofiles
+import httpx
 import boto3
-from pymongo import MongoClient
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
 import openai
+from openai import AsyncOpenAI
+import orjson
 
 # PDF processing imports
 try:
@@ -24,9 +36,26 @@ except ImportError:
     print("Warning: PyPDF2 not installed. PDF processing will be limited.")
     PDF_SUPPORT = False
 
+# Tokenizer imports
+try:
+    import tiktoken
+    TIKTOKEN_SUPPORT = True
+except ImportError:
+    print("Warning: tiktoken not installed. Falling back to character-based chunking.")
+    TIKTOKEN_SUPPORT = False
+
+# Vector search imports for the semantic response cache
+try:
+    import faiss
+    import numpy as np
+    FAISS_SUPPORT = True
+except ImportError:
+    print("Warning: faiss/numpy not installed. Semantic response caching will be disabled.")
+    FAISS_SUPPORT = False
+
 # Neo4j imports
 try:
-    from neo4j import GraphDatabase, Driver, Session, Transaction
+    from neo4j import AsyncGraphDatabase, GraphDatabase
     NEO4J_SUPPORT = True
 except ImportError:
     print("Warning: Neo4j driver not installed. Knowledge graph features will be disabled.")
@@ -35,8 +64,61 @@ except ImportError:
 # Load environment variables
 load_dotenv()
 
+# Read uploads in 1 MB chunks
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Chunk windows sized for the embedding model, with overlap between neighbours
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Tokenizer of the v3 embedding models; tiktoken 0.5.x cannot map them by model name
+EMBEDDING_ENCODING = "cl100k_base"
+CHUNK_TOKENS = 512
+CHUNK_OVERLAP_TOKENS = 64
+
+# Chunk documents written to MongoDB per insert_many call
+CHUNK_INSERT_BATCH_SIZE = 500
+
+# Chunk fields read when answering queries; leaves out the large embedding array
+CHUNK_PROJECTION = {"_id": 0, "chunk_id": 1, "text": 1, "meta.filename": 1, "meta.page": 1}
+
+# Chunks sent per embeddings call, and items buffered between pipeline stages
+EMBEDDING_BATCH_SIZE = 64
+PIPELINE_QUEUE_SIZE = 128
+
+# Answer model for /query, and the response cache in front of it
+CHAT_MODEL = "gpt-4o-mini"
+CHAT_CACHE_TTL_SECONDS = 24 * 60 * 60
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Per-file vector indexes kept in memory, and the size from which they use HNSW
+VECTOR_INDEX_MAX_FILES = 32
+VECTOR_INDEX_HNSW_THRESHOLD = 10000
+
+# Static instructions sent first, so providers can reuse the cached prompt prefix
+SYSTEM_PROMPT = "Based on the following context, answer the question."
+
+# Set at startup if the text index cannot be created; keyword search then uses regex
+TEXT_INDEX_READY = True
+
+def _orjson_default(obj):
+    """Serialize types orjson does not handle natively."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class AppJSONResponse(ORJSONResponse):
+    """orjson-rendered response that also serializes MongoDB ObjectIds."""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_orjson_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+
+
 # Initialize FastAPI app
-app = FastAPI(title="PDF Chat API")
+app = FastAPI(title="PDF Chat API", default_response_class=AppJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -47,28 +129,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Result types returned by the mock clients, built once instead of per call
+_InsertOneResult = namedtuple("InsertOneResult", ["inserted_id"])
+_InsertManyResult = namedtuple("InsertManyResult", ["inserted_ids"])
+_UpdateResult = namedtuple("UpdateResult", ["modified_count"])
+_Embedding = namedtuple("Embedding", ["embedding"])
+_EmbResponse = namedtuple("EmbResponse", ["data"])
+_Msg = namedtuple("Msg", ["content"])
+_Choice = namedtuple("Choice", ["message"])
+_ChatResponse = namedtuple("ChatResponse", ["choices"])
+_Chat = namedtuple("Chat", ["completions"])
+_Delta = namedtuple("Delta", ["content"])
+_StreamChoice = namedtuple("StreamChoice", ["delta"])
+_ChatChunk = namedtuple("ChatChunk", ["choices"])
+_OpenAIClient = namedtuple("OpenAIClient", ["embeddings", "chat"])
+
 # Initialize clients
+MONGODB_URI = os.getenv("MONGODB_URI")
+MONGO_MOCK = False
 try:
-    # Test MongoDB connection without actually connecting
-    if not os.getenv("MONGODB_URI"):
+    if not MONGODB_URI:
         raise Exception("MONGODB_URI not set")
     
     # Skip actual connection for testing
     raise Exception("Using mock MongoDB for testing")
 except Exception as e:
     print(f"Warning: MongoDB client initialization failed: {e}")
-    # Create a mock MongoDB client for testing
+    MONGO_MOCK = True
+    # Create a mock MongoDB client for testing, mirroring motor's async API
+    class MockCursor:
+        def __init__(self, results):
+            self.results = results
+        
+        def limit(self, n):
+            self.results = self.results[:n]
+            return self
+        
+        def sort(self, field, direction=1):
+            if isinstance(field, list):
+                field, direction = field[0]
+            if isinstance(direction, dict):
+                direction = -1  # {"$meta": "textScore"} sorts best matches first
+            self.results = sorted(self.results, key=lambda doc: (doc.get(field) is not None, doc.get(field)), reverse=direction == -1)
+            return self
+        
+        async def to_list(self, length=None):
+            return list(self.results[:length] if length else self.results)
+        
+        async def __aiter__(self):
+            for doc in self.results:
+                yield doc
+    
     class MockCollection:
         def __init__(self, name):
             self.name = name
             self.data = []
+            self.indexes = []
         
-        def insert_one(self, document):
+        async def create_index(self, keys, **kwargs):
+            self.indexes.append((keys, kwargs))
+            return kwargs.get("name", "_".join(f"{k}_{v}" for k, v in keys))
+        
+        async def insert_one(self, document):
             document["_id"] = "mock_id_" + str(len(self.data))
             self.data.append(document)
-            return type('obj', (object,), {'inserted_id': document["_id"]})
+            return _InsertOneResult(document["_id"])
+        
+        async def insert_many(self, documents, ordered=True):
+            inserted_ids = [(await self.insert_one(document)).inserted_id for document in documents]
+            return _InsertManyResult(inserted_ids)
         
-        def find_one(self, query, *args, **kwargs):
+        async def find_one(self, query, *args, **kwargs):
             for doc in self.data:
                 match = True
                 for k, v in query.items():
@@ -79,47 +210,64 @@ except Exception as e:
                     return doc
             return None
         
-        def find(self, query=None, *args, **kwargs):
-            if query is None:
-                results = list(self.data)
-            else:
-                results = []
-                for doc in self.data:
-                    match = True
-                    for k, v in query.items():
-                        if k not in doc:
-                            match = False
-                            break
-                        if isinstance(v, dict) and "$regex" in v:
-                            # Simple regex matching for testing
-                            if v["$regex"] not in doc[k]:
-                                match = False
-                                break
-                        elif doc[k] != v:
-                            match = False
-                            break
-                    if match:
-                        results.append(doc)
-            
-            class MockCursor:
-                def __init__(self, results):
-                    self.results = results
-                
-                def limit(self, n):
-                    return self.results[:n]
-                
-                def sort(self, field, direction):
-                    return self.results
-                
-                def __iter__(self):
-                    return iter(self.results)
+        def find(self, query=None, projection=None, *args, **kwargs):
+            query = dict(query or {})
+            # Approximate $text search as a case-insensitive word match scored by hit count
+            text_terms = re.findall(r"\w+", query.pop("$text", {}).get("$search", "").lower())
+            results = []
+            for doc in self.data:
+                if not self.matches(doc, query):
+                    continue
                 
-                def __list__(self):
-                    return list(self.results)
+                # Return copies, as a real driver would, so callers can annotate results
+                result = dict(doc)
+                if text_terms:
+                    words = re.findall(r"\w+", doc.get("text", "").lower())
+                    score = sum(words.count(term) for term in text_terms)
+                    if not score:
+                        continue
+                    result["score"] = score
+                results.append(self.project(result, projection or {}))
             
             return MockCursor(results)
         
-        def update_one(self, query, update):
+        @staticmethod
+        def matches(doc, query):
+            for k, v in query.items():
+                if k not in doc:
+                    return False
+                if isinstance(v, dict) and "$regex" in v:
+                    flags = re.IGNORECASE if "i" in v.get("$options", "") else 0
+                    if not re.search(v["$regex"], doc[k], flags):
+                        return False
+                elif isinstance(v, dict) and "$in" in v:
+                    if doc[k] not in v["$in"]:
+                        return False
+                elif doc[k] != v:
+                    return False
+            return True
+        
+        @staticmethod
+        def project(doc, projection):
+            included = [k for k, v in projection.items() if v == 1]
+            if included:
+                result = {k: doc[k] for k in ("_id", "score") if k in doc}
+                for path in included:
+                    head, _, rest = path.partition(".")
+                    if head not in doc:
+                        continue
+                    if rest:
+                        result.setdefault(head, {})[rest] = doc[head].get(rest)
+                    else:
+                        result[head] = doc[head]
+            else:
+                result = doc
+            for k, v in projection.items():
+                if v == 0:
+                    result.pop(k, None)
+            return result
+        
+        async def update_one(self, query, update):
             for doc in self.data:
                 match = True
                 for k, v in query.items():
@@ -129,8 +277,8 @@ except Exception as e:
                 if match:
                     for k, v in update["$set"].items():
                         doc[k] = v
-                    return type('obj', (object,), {'modified_count': 1})
-            return type('obj', (object,), {'modified_count': 0})
+                    return _UpdateResult(1)
+            return _UpdateResult(0)
     
     class MockDB:
         def __init__(self):
@@ -138,6 +286,14 @@ except Exception as e:
             self.chunks = MockCollection("chunks")
             self.chat_history = MockCollection("chat_history")
             self.knowledge_graphs = MockCollection("knowledge_graphs")
+            self.chat_cache = MockCollection("chat_cache")
+        
+        async def command(self, command, **kwargs):
+            # Only the explain command is used; the mock always scans
+            return {
+                "queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}},
+                "executionStats": {"nReturned": 0, "totalKeysExamined": 0, "totalDocsExamined": 0, "executionTimeMillis": 0}
+            }
     
     db = MockDB()
 
@@ -158,14 +314,15 @@ except Exception as e:
             print(f"Mock S3 upload: {key} to {bucket}")
             return True
         
-        def get_object(self, Bucket, Key):
+        def download_fileobj(self, Bucket, Key, Fileobj):
             print(f"Mock S3 download: {Key} from {Bucket}")
-            return {"Body": type('obj', (object,), {'read': lambda: b"This is mock content for testing.\nIt contains some text about artificial intelligence.\nAI is transforming how we work and live.\nMachine learning is a subset of AI focused on algorithms that learn from data."})}
+            Fileobj.write(b"This is mock content for testing.\nIt contains some text about artificial intelligence.\nAI is transforming how we work and live.\nMachine learning is a subset of AI focused on algorithms that learn from data.")
     
     s3_client = MockS3Client()
     S3_BUCKET = "mock-bucket"
 
 # Initialize Neo4j client (with mock for testing)
+NEO4J_MOCK = False
 try:
     if NEO4J_SUPPORT:
         neo4j_uri = os.getenv("NEO4J_URI")
@@ -175,14 +332,13 @@ try:
         if not all([neo4j_uri, neo4j_user, neo4j_pass]):
             raise Exception("Neo4j environment variables not set")
         
-        neo4j_driver = GraphDatabase.driver(neo4j_uri, auth=(neo4j_user, neo4j_pass))
-        
-        # Test connection
-        with neo4j_driver.session() as session:
-            result = session.run("RETURN 1 as test")
-            test_value = result.single()["test"]
-            if test_value != 1:
-                raise Exception("Neo4j connection test failed")
+        # Test connection with a short-lived sync driver, as no event loop runs at import
+        with GraphDatabase.driver(neo4j_uri, auth=(neo4j_user, neo4j_pass)) as probe_driver:
+            with probe_driver.session() as session:
+                result = session.run("RETURN 1 as test")
+                test_value = result.single()["test"]
+                if test_value != 1:
+                    raise Exception("Neo4j connection test failed")
             
         print("Neo4j connected successfully")
     else:
@@ -190,34 +346,98 @@ try:
         
 except Exception as e:
     print(f"Warning: Neo4j client initialization failed: {e}")
-    # Create a mock Neo4j client for testing
+    NEO4J_MOCK = True
+    # Create a mock Neo4j client for testing, mirroring the async driver
+    class MockNeo4jResult:
+        async def __aiter__(self):
+            for record in []:
+                yield record
+        
+        async def data(self):
+            return [{"n": {"name": "Test"}}]
+        
+        async def single(self):
+            return {"test": 1}
+        
+        async def consume(self):
+            pass
+    
     class MockNeo4jSession:
-        def run(self, query, **kwargs):
+        async def run(self, query, **kwargs):
             print(f"Mock Neo4j query: {query[:50]}...")
-            return type('obj', (object,), {
-                'data': lambda: [{"n": {"name": "Test"}}],
-                'single': lambda: {"test": 1}
-            })
+            return MockNeo4jResult()
         
-        def close(self):
+        async def execute_read(self, transaction_function, *args, **kwargs):
+            return await transaction_function(self, *args, **kwargs)
+        
+        async def execute_write(self, transaction_function, *args, **kwargs):
+            return await transaction_function(self, *args, **kwargs)
+        
+        async def close(self):
             pass
         
-        def __enter__(self):
+        async def __aenter__(self):
             return self
             
-        def __exit__(self, exc_type, exc_val, exc_tb):
+        async def __aexit__(self, exc_type, exc_val, exc_tb):
             pass
     
     class MockNeo4jDriver:
         def session(self):
             return MockNeo4jSession()
             
-        def close(self):
+        async def close(self):
             pass
+
+
+def create_neo4j_driver():
+    """Create an async Neo4j driver.
     
-    neo4j_driver = MockNeo4jDriver()
+    Its connection pool belongs to the event loop that uses it, so worker jobs
+    running on their own loop create (and close) their own driver.
+    """
+    if NEO4J_MOCK:
+        return MockNeo4jDriver()
+    return AsyncGraphDatabase.driver(
+        neo4j_uri,
+        auth=(neo4j_user, neo4j_pass),
+        max_connection_pool_size=50,
+        connection_acquisition_timeout=30,
+        fetch_size=1000
+    )
+
+
+# Driver for request handlers, which all run on the server's event loop
+neo4j_driver = create_neo4j_driver()
+
+
+@asynccontextmanager
+async def _with_session(driver=None):
+    """Check out a session backed by the driver's connection pool."""
+    async with (driver or neo4j_driver).session() as session:
+        yield session
+
+
+def neo4j_read(tx_fn):
+    """Run a transaction function as a managed read, routable to cluster replicas."""
+    @functools.wraps(tx_fn)
+    async def wrapper(*args, driver=None, **kwargs):
+        async with _with_session(driver) as session:
+            return await session.execute_read(tx_fn, *args, **kwargs)
+    return wrapper
+
+
+def neo4j_write(tx_fn):
+    """Run a transaction function as a managed write, retried on transient errors."""
+    @functools.wraps(tx_fn)
+    async def wrapper(*args, driver=None, **kwargs):
+        async with _with_session(driver) as session:
+            return await session.execute_write(tx_fn, *args, **kwargs)
+    return wrapper
+
 
 # Initialize OpenAI (with mock for testing)
+OPENAI_MOCK = False
 try:
     openai.api_key = os.getenv("OPENAI_API_KEY")
     # Test the API key
@@ -227,21 +447,29 @@ try:
     )
 except Exception as e:
     print(f"Warning: OpenAI API initialization failed: {e}")
+    OPENAI_MOCK = True
     # Create a mock OpenAI client for testing
     class MockEmbeddings:
-        def create(self, **kwargs):
-            print(f"Mock OpenAI embeddings: {kwargs.get('input')[:20]}...")
-            return type('obj', (object,), {
-                'data': [type('obj', (object,), {'embedding': [0.1] * 1536})]
-            })
+        async def create(self, **kwargs):
+            inputs = kwargs.get('input')
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            print(f"Mock OpenAI embeddings: {len(inputs)} input(s), {inputs[0][:20]}...")
+            return _EmbResponse([_Embedding(self.embed(text)) for text in inputs])
+        
+        @staticmethod
+        def embed(text):
+            # Deterministic per text, so identical inputs compare as identical
+            digest = hashlib.sha256(text.encode()).digest()
+            return [(digest[i % len(digest)] - 127.5) / 127.5 for i in range(1536)]
     
     class MockChat:
         def completions(self):
             return self
         
-        def create(self, **kwargs):
-clear            messages = kwargs.get('messages', [{}])
-            prompt = messages[-1].get('content', '')
+        async def create(self, **kwargs):
+            messages = kwargs.get('messages', [{}])
+            prompt = "\n\n".join(message.get('content', '') for message in messages)
             print(f"Mock OpenAI chat: {prompt[:50]}...")
             
             # Extract context and question from the prompt
@@ -261,21 +489,241 @@ clear            messages = kwargs.get('messages', [{}])
                     
                 answer += f"\n\nIn response to your question: '{question}', "
                 answer += "the document provides these details from the relevant sections."
+            elif kwargs.get('response_format', {}).get('type') == 'json_object':
+                # Entity extraction runs in JSON mode
+                answer = '{"entities": [], "relationships": []}'
             else:
-                # For entity extraction or other prompts
                 answer = "Entities extracted from the document include the key concepts mentioned in the text."
             
-            return type('obj', (object,), {
-                'choices': [type('obj', (object,), {
-                    'message': type('obj', (object,), {
-                        'content': answer
-                    })
-                })]
-            })
+            if kwargs.get('stream'):
+                return self.stream(answer)
+            return _ChatResponse([_Choice(_Msg(answer))])
+        
+        @staticmethod
+        async def stream(answer):
+            for token in re.findall(r"\S+\s*", answer):
+                yield _ChatChunk([_StreamChoice(_Delta(token))])
     
-    # Replace OpenAI modules with mocks
-    openai.embeddings = MockEmbeddings()
-    openai.chat = type('obj', (object,), {'completions': MockChat()})
+    mock_openai_client = _OpenAIClient(MockEmbeddings(), _Chat(MockChat()))
+
+
+def create_openai_client():
+    """Create an async OpenAI client.
+    
+    Its connection pool belongs to the event loop that first uses it, so
+    worker jobs running on their own loop create their own client.
+    """
+    if OPENAI_MOCK:
+        return mock_openai_client
+    # One keep-alive HTTP/2 pool shared by embedding and chat calls
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            http2=True
+        )
+    )
+
+
+# Client for request handlers, which all run on the server's event loop
+oai = create_openai_client()
+
+# Worker pool for file processing, kept off the request-handling event loop.
+# The mock DB only lives in this process's memory, so it can only be shared
+# with threads; a real database lets the CPU-heavy parsing use processes.
+PROCESSING_WORKERS = int(os.getenv("PROCESSING_WORKERS", os.cpu_count() or 1))
+
+
+def _init_worker():
+    """Give each worker process its own MongoDB connection pool."""
+    global db
+    db = AsyncIOMotorClient(MONGODB_URI).brain
+
+
+if MONGO_MOCK:
+    executor = ThreadPoolExecutor(max_workers=PROCESSING_WORKERS)
+else:
+    # Spawned rather than forked: workers never inherit the server's client threads or locks
+    executor = ProcessPoolExecutor(
+        max_workers=PROCESSING_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker
+    )
+
+# In-flight processing jobs by file_id, so status long-polls can await completion
+processing_jobs: Dict[str, Any] = {}
+STATUS_WAIT_MAX_SECONDS = 60
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create a compound index for every (user_id, file_id[, ...]) access pattern."""
+    global TEXT_INDEX_READY
+    await db.files.create_index([("user_id", 1), ("file_id", 1)], unique=True)
+    await db.files.create_index([("user_id", 1), ("content_sha256", 1), ("status", 1)])
+    # Serves /files?sort=-created_at&limit=N without an in-memory sort
+    await db.files.create_index([("user_id", 1), ("created_at", -1)])
+    # Its (user_id, file_id) prefix also serves whole-file chunk scans, including the
+    # unanchored text_lower regexes, which no index on text_lower itself could narrow further
+    await db.chunks.create_index([("user_id", 1), ("file_id", 1), ("chunk_id", 1)])
+    try:
+        await db.chunks.create_index([("text", "text")], name="chunks_text_idx")
+    except Exception as e:
+        print(f"Warning: Could not create text index, keyword search will use regex: {e}")
+        TEXT_INDEX_READY = False
+    await db.chat_cache.create_index([("user_id", 1), ("file_id", 1), ("query_hash", 1)])
+    # Newest-first history with and without a session_id filter; each needs its own index to skip the sort
+    await db.chat_history.create_index([("file_id", 1), ("user_id", 1), ("session_id", 1), ("created_at", -1)])
+    await db.chat_history.create_index([("file_id", 1), ("user_id", 1), ("created_at", -1)])
+    await db.chat_cache.create_index([("created_at", 1)], expireAfterSeconds=CHAT_CACHE_TTL_SECONDS)
+    await db.knowledge_graphs.create_index([("user_id", 1), ("file_id", 1)])
+
+
+@app.on_event("startup")
+async def backfill_text_lower():
+    """Give chunks stored before text_lower existed their lowercase copy, so keyword matching finds them."""
+    if MONGO_MOCK:
+        return  # In-memory chunks are always created with text_lower
+    result = await db.chunks.update_many(
+        {"text_lower": {"$exists": False}},
+        [{"$set": {"text_lower": {"$toLower": "$text"}}}]
+    )
+    if result.modified_count:
+        print(f"Backfilled text_lower on {result.modified_count} chunks")
+
+
+class SemanticCache:
+    """In-process cosine-similarity lookup from query embeddings to chat_cache entries.
+    
+    One FAISS inner-product index per (user_id, file_id, use_kg) over normalized
+    embeddings, so knowledge-graph and vector-only answers never stand in for
+    each other. Hits are re-read from MongoDB, so TTL-expired entries miss.
+    """
+    
+    def __init__(self):
+        self.indexes: Dict[Tuple[str, str, bool], Any] = {}
+        self.hashes: Dict[Tuple[str, str, bool], List[str]] = {}
+    
+    def add(self, user_id: str, file_id: str, use_kg: bool, query_hash: str, embedding: List[float]) -> None:
+        if not FAISS_SUPPORT:
+            return
+        key = (user_id, file_id, use_kg)
+        if key not in self.indexes:
+            self.indexes[key] = faiss.IndexFlatIP(len(embedding))
+            self.hashes[key] = []
+        vector = np.array([embedding], dtype="float32")
+        faiss.normalize_L2(vector)
+        self.indexes[key].add(vector)
+        self.hashes[key].append(query_hash)
+    
+    def search(self, user_id: str, file_id: str, use_kg: bool, embedding: List[float]) -> Optional[str]:
+        """Return the query_hash of the closest cached query above the threshold."""
+        key = (user_id, file_id, use_kg)
+        index = self.indexes.get(key)
+        if index is None or index.ntotal == 0:
+            return None
+        vector = np.array([embedding], dtype="float32")
+        faiss.normalize_L2(vector)
+        scores, ids = index.search(vector, 1)
+        if scores[0][0] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return self.hashes[key][ids[0][0]]
+
+
+semantic_cache = SemanticCache()
+
+
+class VectorIndex:
+    """Per-file FAISS indexes over chunk embeddings, built from MongoDB on first query.
+    
+    Only processed files are indexed, and the most recently used ones stay in
+    memory. The server drops a file's entry when its processing job finishes,
+    so the next query rebuilds it from the final chunks.
+    """
+    
+    def __init__(self, max_files: int = VECTOR_INDEX_MAX_FILES):
+        self.entries: OrderedDict = OrderedDict()
+        self.max_files = max_files
+    
+    @staticmethod
+    def _make_index(embeddings: List[List[float]]):
+        vectors = np.array(embeddings, dtype="float32")
+        faiss.normalize_L2(vectors)
+        if len(vectors) >= VECTOR_INDEX_HNSW_THRESHOLD:
+            index = faiss.IndexHNSWFlat(vectors.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexFlatIP(vectors.shape[1])
+        index.add(vectors)
+        return index
+    
+    async def _build(self, user_id: str, file_id: str):
+        chunk_ids = []
+        embeddings = []
+        async for chunk in db.chunks.find({"file_id": file_id, "user_id": user_id}, {"chunk_id": 1, "embedding": 1, "_id": 0}):
+            chunk_ids.append(chunk["chunk_id"])
+            embeddings.append(chunk["embedding"])
+        if not embeddings:
+            return None
+        index = await asyncio.to_thread(self._make_index, embeddings)
+        return index, chunk_ids
+    
+    async def search(self, user_id: str, file_id: str, embedding: List[float], k: int) -> List[str]:
+        """Return the chunk IDs of the k nearest chunks, best first."""
+        key = (user_id, file_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            # A file still being processed has a partial chunk set: search nothing rather than cache it
+            file = await db.files.find_one({"file_id": file_id, "user_id": user_id}, {"status": 1, "_id": 0})
+            if not file or file.get("status") != "processed":
+                return []
+            entry = await self._build(user_id, file_id)
+            if entry is None:
+                return []
+            self.entries[key] = entry
+            if len(self.entries) > self.max_files:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        
+        index, chunk_ids = entry
+        vector = np.array([embedding], dtype="float32")
+        faiss.normalize_L2(vector)
+        _, ids = index.search(vector, min(k, len(chunk_ids)))
+        return [chunk_ids[i] for i in ids[0] if i >= 0]
+    
+    def invalidate(self, user_id: str, file_id: str) -> None:
+        self.entries.pop((user_id, file_id), None)
+
+
+vector_index = VectorIndex()
+
+
+@app.on_event("startup")
+async def load_semantic_cache():
+    """Rebuild the semantic cache from the cached answers still in MongoDB."""
+    if not FAISS_SUPPORT:
+        return
+    count = 0
+    projection = {"user_id": 1, "file_id": 1, "use_kg": 1, "query_hash": 1, "embedding": 1}
+    async for entry in db.chat_cache.find({}, projection):
+        # Entries cached before use_kg was recorded stay reachable by exact hash only
+        if entry.get("embedding") and "use_kg" in entry:
+            semantic_cache.add(entry["user_id"], entry["file_id"], entry["use_kg"], entry["query_hash"], entry["embedding"])
+            count += 1
+    print(f"Loaded {count} cached answers into the semantic cache")
+
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    """Stop accepting new processing jobs on shutdown."""
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.on_event("shutdown")
+async def close_neo4j_driver():
+    """Release the server's Neo4j connection pool."""
+    await neo4j_driver.close()
 
 
 # Models
@@ -290,6 +738,7 @@ class QueryRequest(BaseModel):
     file_id: str
     session_id: Optional[str] = None
     use_kg: bool = True  # Whether to use knowledge graph for retrieval
+    max_chars: Optional[int] = Field(None, ge=1)  # Cap on each source's preview text, for clients showing a prefix
 
 
 class QueryResponse(BaseModel):
@@ -322,28 +771,38 @@ class GraphResponse(BaseModel):
 
 
 # Knowledge graph extraction functions
-def extract_entities_and_relationships(text: str, file_id: str) -> Tuple[List[Dict], List[Dict]]:
-    """Extract entities and relationships from text using OpenAI."""
-    try:
-        print("Extracting entities and relationships from text...")
-        
-        # Split text into manageable chunks for extraction
-        chunks = []
-        max_chunk_size = 8000  # Characters per chunk for entity extraction
-        for i in range(0, len(text), max_chunk_size):
-            chunks.append(text[i:i+max_chunk_size])
-        
-        all_entities = {}
-        all_relationships = []
-        
-        # Process each chunk
-        for i, chunk in enumerate(chunks):
-            # Estimate page number based on chunk index
-            page_num = i + 1
+async def extract_entities_and_relationships(pages: asyncio.Queue, file_id: str, client) -> Tuple[List[Dict], List[Dict]]:
+    """Extract entities and relationships using OpenAI from a queue of (page number, text) items.
+    
+    Pages are accumulated into segments of about 8000 characters per call. The
+    queue is always drained to its None sentinel so the producer never stalls.
+    """
+    print("Extracting entities and relationships from text...")
+    
+    max_chunk_size = 8000  # Characters per chunk for entity extraction
+    all_entities = {}
+    all_relationships = []
+    buffer = ""
+    buffer_page = 1
+    
+    while True:
+        item = await pages.get()
+        if item is not None:
+            page, page_text = item
+            if not buffer:
+                buffer_page = page
+            buffer += page_text
+        
+        while len(buffer) >= max_chunk_size or (item is None and buffer):
+            chunk, buffer = buffer[:max_chunk_size], buffer[max_chunk_size:]
+            page_num = buffer_page
+            if buffer and item is not None:
+                buffer_page = item[0]
             
-            # Extract entities and relationships using OpenAI
-            prompt = f"""Extract key entities and their relationships from this text. 
-Format as JSON with these arrays:
+            try:
+                # Extract entities and relationships using OpenAI
+                prompt = f"""Extract key entities and their relationships from this text. 
+Format as a JSON object with these arrays:
 1. entities: [{{"name": "entity name", "type": "PERSON|ORGANIZATION|CONCEPT|TECHNOLOGY|LOCATION|DATE"}}]
 2. relationships: [{{"source": "source entity", "target": "target entity", "type": "relationship type", "context": "brief context"}}]
 
@@ -351,160 +810,237 @@ Text:
 {chunk}
 
 JSON:"""
-            
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1500,
-                temperature=0
-            )
-            
-            result_text = response.choices[0].message.content
-            
-            # Extract JSON from response
-            try:
-                # Find JSON content - look for content between ``` markers if present
-                json_match = re.search(r'```json\s*(.*?)\s*```', result_text, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(1)
-                else:
-                    # Try to find any JSON-like structure
-                    json_match = re.search(r'\{\s*"entities"\s*:\s*\[.*?\]\s*,\s*"relationships"\s*:\s*\[.*?\]\s*\}', result_text, re.DOTALL)
-                    if json_match:
-                        json_str = json_match.group(0)
-                    else:
-                        json_str = result_text
                 
-                data = json.loads(json_str)
+                # JSON mode guarantees a parseable object, so no scrubbing is needed
+                response = await client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=1500,
+                    temperature=0,
+                    response_format={"type": "json_object"}
+                )
                 
-                # Process entities
-                for entity in data.get("entities", []):
-                    entity_name = entity.get("name", "").strip()
-                    if not entity_name:
-                        continue
-                        
-                    entity_id = f"{file_id}_{entity_name.lower().replace(' ', '_')}"
-                    
-                    if entity_id in all_entities:
-                        # Update existing entity
-                        if page_num not in all_entities[entity_id]["mentions"]:
-                            all_entities[entity_id]["mentions"].append(page_num)
-                    else:
-                        # Add new entity
-                        all_entities[entity_id] = {
-                            "id": entity_id,
-                            "name": entity_name,
-                            "type": entity.get("type", "CONCEPT"),
-                            "mentions": [page_num]
-                        }
+                result_text = response.choices[0].message.content
                 
-                # Process relationships
-                for rel in data.get("relationships", []):
-                    source = rel.get("source", "").strip()
-                    target = rel.get("target", "").strip()
+                try:
+                    data = orjson.loads(result_text)
                     
-                    if not source or not target:
-                        continue
+                    # Process entities
+                    for entity in data.get("entities", []):
+                        entity_name = entity.get("name", "").strip()
+                        if not entity_name:
+                            continue
+                    
+                        entity_id = f"{file_id}_{entity_name.lower().replace(' ', '_')}"
+                    
+                        if entity_id in all_entities:
+                            # Update existing entity
+                            if page_num not in all_entities[entity_id]["mentions"]:
+                                all_entities[entity_id]["mentions"].append(page_num)
+                        else:
+                            # Add new entity
+                            all_entities[entity_id] = {
+                                "id": entity_id,
+                                "name": entity_name,
+                                "type": entity.get("type", "CONCEPT"),
+                                "mentions": [page_num]
+                            }
                     
-                    source_id = f"{file_id}_{source.lower().replace(' ', '_')}"
-                    target_id = f"{file_id}_{target.lower().replace(' ', '_')}"
+                    # Process relationships
+                    for rel in data.get("relationships", []):
+                        source = rel.get("source", "").strip()
+                        target = rel.get("target", "").strip()
                     
-                    # Ensure both entities exist
-                    if source not in [e["name"] for e in all_entities.values()]:
-                        all_entities[source_id] = {
-                            "id": source_id,
-                            "name": source,
-                            "type": "CONCEPT",
-                            "mentions": [page_num]
-                        }
+                        if not source or not target:
+                            continue
                     
-                    if target not in [e["name"] for e in all_entities.values()]:
-                        all_entities[target_id] = {
-                            "id": target_id,
-                            "name": target,
-                            "type": "CONCEPT",
-                            "mentions": [page_num]
-                        }
+                        source_id = f"{file_id}_{source.lower().replace(' ', '_')}"
+                        target_id = f"{file_id}_{target.lower().replace(' ', '_')}"
                     
-                    # Add relationship
-                    all_relationships.append({
-                        "source": source_id,
-                        "target": target_id,
-                        "type": rel.get("type", "RELATED_TO"),
-                        "context": rel.get("context", f"Mentioned on page {page_num}")
-                    })
+                        # Ensure both entities exist
+                        if source not in [e["name"] for e in all_entities.values()]:
+                            all_entities[source_id] = {
+                                "id": source_id,
+                                "name": source,
+                                "type": "CONCEPT",
+                                "mentions": [page_num]
+                            }
                     
-            except json.JSONDecodeError as e:
-                print(f"Error parsing JSON from OpenAI response: {e}")
-                print(f"Response text: {result_text[:200]}...")
+                        if target not in [e["name"] for e in all_entities.values()]:
+                            all_entities[target_id] = {
+                                "id": target_id,
+                                "name": target,
+                                "type": "CONCEPT",
+                                "mentions": [page_num]
+                            }
+                    
+                        # Add relationship
+                        all_relationships.append({
+                            "source": source_id,
+                            "target": target_id,
+                            "type": rel.get("type", "RELATED_TO"),
+                            "context": rel.get("context", f"Mentioned on page {page_num}")
+                        })
+                    
+                except orjson.JSONDecodeError as e:
+                    print(f"Error parsing JSON from OpenAI response: {e}")
+                    print(f"Response text: {result_text[:200]}...")
         
-        return list(all_entities.values()), all_relationships
+            except Exception as e:
+                print(f"Error extracting entities and relationships: {e}")
+                import traceback
+                traceback.print_exc()
         
-    except Exception as e:
-        print(f"Error extracting entities and relationships: {e}")
-        import traceback
-        traceback.print_exc()
-        return [], []
+        if item is None:
+            break
+    
+    return list(all_entities.values()), all_relationships
 
 
-def create_knowledge_graph(entities: List[Dict], relationships: List[Dict], user_id: str, file_id: str) -> None:
+@neo4j_write
+async def replace_file_graph(tx, entities: List[Dict], relationships: List[Dict], user_id: str, file_id: str) -> None:
+    """Replace the Neo4j subgraph of a file within one write transaction."""
+    # Clear existing graph for this file
+    await tx.run("""
+        MATCH (e:Entity)
+        WHERE e.file_id = $file_id AND e.user_id = $user_id
+        DETACH DELETE e
+    """, file_id=file_id, user_id=user_id)
+    
+    # Create entities
+    for entity in entities:
+        await tx.run("""
+            CREATE (e:Entity {
+                id: $id,
+                name: $name,
+                type: $type,
+                mentions: $mentions,
+                file_id: $file_id,
+                user_id: $user_id
+            })
+        """, 
+        id=entity["id"],
+        name=entity["name"],
+        type=entity["type"],
+        mentions=entity["mentions"],
+        file_id=file_id,
+        user_id=user_id
+        )
+    
+    # Create relationships
+    for rel in relationships:
+        await tx.run("""
+            MATCH (source:Entity {id: $source_id})
+            MATCH (target:Entity {id: $target_id})
+            CREATE (source)-[r:RELATIONSHIP {
+                type: $type,
+                context: $context,
+                file_id: $file_id,
+                user_id: $user_id
+            }]->(target)
+        """,
+        source_id=rel["source"],
+        target_id=rel["target"],
+        type=rel["type"],
+        context=rel["context"],
+        file_id=file_id,
+        user_id=user_id
+        )
+
+
+@neo4j_write
+async def copy_file_graph(tx, source_file_id: str, source_user_id: str, file_id: str, user_id: str) -> None:
+    """Copy the Neo4j subgraph of one file to another, rewriting entity IDs."""
+    await tx.run("""
+        MATCH (e:Entity)
+        WHERE e.file_id = $source_file_id AND e.user_id = $source_user_id
+        CREATE (:Entity {
+            id: $file_id + substring(e.id, size($source_file_id)),
+            name: e.name,
+            type: e.type,
+            mentions: e.mentions,
+            file_id: $file_id,
+            user_id: $user_id
+        })
+    """, source_file_id=source_file_id, source_user_id=source_user_id, file_id=file_id, user_id=user_id)
+    
+    await tx.run("""
+        MATCH (e1:Entity)-[r:RELATIONSHIP]->(e2:Entity)
+        WHERE e1.file_id = $source_file_id AND e1.user_id = $source_user_id
+        MATCH (source:Entity {id: $file_id + substring(e1.id, size($source_file_id))})
+        MATCH (target:Entity {id: $file_id + substring(e2.id, size($source_file_id))})
+        CREATE (source)-[:RELATIONSHIP {
+            type: r.type,
+            context: r.context,
+            file_id: $file_id,
+            user_id: $user_id
+        }]->(target)
+    """, source_file_id=source_file_id, source_user_id=source_user_id, file_id=file_id, user_id=user_id)
+
+
+@neo4j_read
+async def read_file_graph(tx, file_id: str, user_id: str) -> Tuple[List[Dict], List[Dict]]:
+    """Read the nodes and edges of a file's subgraph for visualization."""
+    nodes = []
+    edges = []
+    
+    # Nodes and edges in one round-trip, streamed and told apart by `kind`
+    result = await tx.run("""
+        CALL {
+            MATCH (e:Entity)
+            WHERE e.file_id = $file_id AND e.user_id = $user_id
+            RETURN 'node' AS kind, e.id AS id, e.name AS name, e.type AS type, e.mentions AS mentions,
+                   null AS source, null AS target, null AS context
+            LIMIT 100
+            UNION ALL
+            MATCH (e1:Entity)-[r:RELATIONSHIP]->(e2:Entity)
+            WHERE e1.file_id = $file_id AND e1.user_id = $user_id
+            RETURN 'edge' AS kind, null AS id, null AS name, r.type AS type, null AS mentions,
+                   e1.id AS source, e2.id AS target, r.context AS context
+            LIMIT 500
+        }
+        RETURN kind, id, name, type, mentions, source, target, context
+    """, file_id=file_id, user_id=user_id)
+    
+    async for record in result:
+        if record["kind"] == "node":
+            nodes.append({
+                "id": record["id"],
+                "label": record["name"],
+                "type": record["type"],
+                "mentions": record["mentions"],
+                "size": len(record["mentions"]) * 5  # Size based on mention count
+            })
+        else:
+            edges.append({
+                "source": record["source"],
+                "target": record["target"],
+                "label": record["type"],
+                "context": record["context"]
+            })
+    
+    return nodes, edges
+
+
+async def create_knowledge_graph(entities: List[Dict], relationships: List[Dict], user_id: str, file_id: str, driver=None) -> None:
     """Create knowledge graph in Neo4j."""
     try:
         print(f"Creating knowledge graph for file {file_id}...")
         
-        with neo4j_driver.session() as session:
-            # Create constraints if they don't exist (idempotent)
-            try:
-                session.run("CREATE CONSTRAINT unique_entity_id IF NOT EXISTS FOR (e:Entity) REQUIRE e.id IS UNIQUE")
-            except Exception as e:
-                print(f"Warning: Could not create constraint: {e}")
-            
-            # Clear existing graph for this file
-            session.run("""
-                MATCH (e:Entity)
-                WHERE e.file_id = $file_id AND e.user_id = $user_id
-                DETACH DELETE e
-            """, file_id=file_id, user_id=user_id)
-            
-            # Create entities
-            for entity in entities:
-                session.run("""
-                    CREATE (e:Entity {
-                        id: $id,
-                        name: $name,
-                        type: $type,
-                        mentions: $mentions,
-                        file_id: $file_id,
-                        user_id: $user_id
-                    })
-                """, 
-                id=entity["id"],
-                name=entity["name"],
-                type=entity["type"],
-                mentions=entity["mentions"],
-                file_id=file_id,
-                user_id=user_id
-                )
-            
-            # Create relationships
-            for rel in relationships:
-                session.run("""
-                    MATCH (source:Entity {id: $source_id})
-                    MATCH (target:Entity {id: $target_id})
-                    CREATE (source)-[r:RELATIONSHIP {
-                        type: $type,
-                        context: $context,
-                        file_id: $file_id,
-                        user_id: $user_id
-                    }]->(target)
-                """,
-                source_id=rel["source"],
-                target_id=rel["target"],
-                type=rel["type"],
-                context=rel["context"],
-                file_id=file_id,
-                user_id=user_id
-                )
+        # Create constraints and indexes if they don't exist (idempotent); schema
+        # changes cannot share a transaction with data writes
+        async with _with_session(driver) as session:
+            for statement in [
+                "CREATE CONSTRAINT unique_entity_id IF NOT EXISTS FOR (e:Entity) REQUIRE e.id IS UNIQUE",
+                "CREATE INDEX entity_file_user IF NOT EXISTS FOR (e:Entity) ON (e.file_id, e.user_id)"
+            ]:
+                try:
+                    result = await session.run(statement)
+                    await result.consume()
+                except Exception as e:
+                    print(f"Warning: Could not create schema: {e}")
+        
+        await replace_file_graph(entities, relationships, user_id, file_id, driver=driver)
                 
         print(f"Knowledge graph created with {len(entities)} entities and {len(relationships)} relationships")
         
@@ -515,120 +1051,236 @@ def create_knowledge_graph(entities: List[Dict], relationships: List[Dict], user
 
 
 # Helper functions
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extract text from a PDF file."""
+def upload_to_s3(local_path: str, s3_key: str) -> None:
+    """Upload a local file to S3 (boto3 switches to multipart for large files); blocking."""
+    with open(local_path, "rb") as file_obj:
+        s3_client.upload_fileobj(file_obj, S3_BUCKET, s3_key)
+
+
+def download_from_s3(s3_key: str, local_path: str) -> None:
+    """Stream an S3 object to a local file; blocking."""
+    with open(local_path, "wb") as f:
+        s3_client.download_fileobj(S3_BUCKET, s3_key, f)
+
+
+def iter_pdf_pages(file_path: str):
+    """Yield (page number, text) for each page of a PDF file as it is parsed."""
     if not PDF_SUPPORT:
         raise Exception("PyPDF2 not installed. Cannot process PDF files.")
     
-    text = ""
     try:
         with open(file_path, 'rb') as f:
             pdf_reader = PyPDF2.PdfReader(f)
             for page_num, page in enumerate(pdf_reader.pages):
                 page_text = page.extract_text()
                 if page_text:
-                    text += f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
-        return text
+                    yield page_num + 1, f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
     except Exception as e:
         print(f"Error extracting PDF text: {e}")
         raise
 
 
+def iter_text_blocks(file_path: str):
+    """Yield a plain text file in blocks, all attributed to page 1."""
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        while block := f.read(UPLOAD_CHUNK_SIZE):
+            yield 1, block
+
+
+def extract_text_from_pdf(file_path: str) -> str:
+    """Extract text from a PDF file."""
+    return "".join(page_text for _, page_text in iter_pdf_pages(file_path))
+
+
+class TextChunker:
+    """Split a stream of text into overlapping token windows for embedding.
+    
+    Falls back to 1000-character windows without overlap when tiktoken is missing.
+    """
+    
+    def __init__(self):
+        if TIKTOKEN_SUPPORT:
+            self.encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
+            self.size, self.overlap = CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS
+        else:
+            self.encoding = None
+            self.size, self.overlap = 1000, 0  # characters
+        self.buffer = []
+        self.emitted = False
+    
+    def _decode(self, units) -> str:
+        return self.encoding.decode(units) if self.encoding else "".join(units)
+    
+    def feed(self, text: str) -> List[str]:
+        """Add text and return every window that is now complete."""
+        self.buffer.extend(self.encoding.encode(text) if self.encoding else text)
+        chunks = []
+        while len(self.buffer) >= self.size:
+            chunks.append(self._decode(self.buffer[:self.size]))
+            del self.buffer[:self.size - self.overlap]
+            self.emitted = True
+        return [chunk for chunk in chunks if chunk.strip()]
+    
+    def flush(self) -> List[str]:
+        """Return the final partial window."""
+        # A tail no longer than the overlap is already covered by the previous window
+        tail = self.buffer
+        self.buffer = []
+        if len(tail) > self.overlap or (tail and not self.emitted):
+            chunk = self._decode(tail)
+            if chunk.strip():
+                return [chunk]
+        return []
+
+
+def split_into_chunks(text: str) -> List[str]:
+    """Split text into overlapping token windows for embedding."""
+    chunker = TextChunker()
+    return chunker.feed(text) + chunker.flush()
+
+
 def process_file(user_id: str, file_id: str, filename: str, s3_key: str, local_path: str = None):
-    """Process file in background."""
-    try:
-        print(f"Processing file: {filename} (ID: {file_id})")
-        
-        # Update status to processing
-        db.files.update_one(
-            {"file_id": file_id},
-            {"$set": {"status": "processing"}}
+    """Process file in a worker, on the worker's own event loop."""
+    asyncio.run(_process_file(user_id, file_id, filename, s3_key, local_path))
+
+
+async def extract_pages(local_path: str, filename: str, outputs: List[asyncio.Queue]):
+    """Producer: parse the file off the event loop and push each page to every output queue."""
+    if filename.lower().endswith('.pdf'):
+        print("Extracting text from PDF...")
+        pages = iter_pdf_pages(local_path)
+    else:
+        pages = iter_text_blocks(local_path)
+    
+    total_chars = 0
+    while (item := await asyncio.to_thread(next, pages, None)) is not None:
+        total_chars += len(item[1].strip())
+        for queue in outputs:
+            await queue.put(item)
+    
+    if total_chars < 10:
+        raise Exception("No text content extracted from file")
+    
+    print(f"Extracted {total_chars} characters from {filename}")
+    for queue in outputs:
+        await queue.put(None)
+
+
+async def chunk_pages(pages: asyncio.Queue, chunks: asyncio.Queue):
+    """Chunker: turn the page stream into fixed-token chunks tagged with their page."""
+    chunker = TextChunker()
+    page = 1
+    while (item := await pages.get()) is not None:
+        page, page_text = item
+        for chunk_text in chunker.feed(page_text):
+            await chunks.put((page, chunk_text))
+    for chunk_text in chunker.flush():
+        await chunks.put((page, chunk_text))
+    await chunks.put(None)
+
+
+async def embed_chunks(chunks: asyncio.Queue, client, user_id: str, file_id: str, filename: str) -> int:
+    """Embedder: embed chunks in batches and bulk-insert them into MongoDB."""
+    docs: List[Dict] = []
+    count = 0
+    done = False
+    while not done:
+        batch = []
+        while len(batch) < EMBEDDING_BATCH_SIZE:
+            item = await chunks.get()
+            if item is None:
+                done = True
+                break
+            batch.append(item)
+        if not batch:
+            break
+        
+        response = await client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[chunk_text for _, chunk_text in batch]
         )
         
-        # Extract text from file
-        text = ""
-        
-        if local_path and os.path.exists(local_path):
-            # Use local file
-            print(f"Reading from local file: {local_path}")
-            
-            if filename.lower().endswith('.pdf'):
-                # Extract text from PDF
-                print("Extracting text from PDF...")
-                text = extract_text_from_pdf(local_path)
-                print(f"Extracted {len(text)} characters from PDF")
-            else:
-                # Read as text file
-                with open(local_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    text = f.read()
-        else:
-            # Fallback to S3
-            print(f"Downloading from S3: {s3_key}")
-            response = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)
-            content = response['Body'].read()
-            
-            if filename.lower().endswith('.pdf'):
-                # Extract text from PDF bytes
-                pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-                for page_num, page in enumerate(pdf_reader.pages):
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
-            else:
-                text = content.decode('utf-8', errors='ignore')
-        
-        if not text or len(text.strip()) < 10:
-            raise Exception("No text content extracted from file")
-        
-        print(f"Total text length: {len(text)} characters")
-        
-        # Create chunks
-        chunk_size = 1000  # characters
-        chunks = []
-        for i in range(0, len(text), chunk_size):
-            chunk_text = text[i:i+chunk_size]
-            if chunk_text.strip():  # Only add non-empty chunks
-                chunks.append(chunk_text)
-        
-        print(f"Created {len(chunks)} chunks")
-        
-        # Create embeddings and store chunks
-        for i, chunk_text in enumerate(chunks):
-            # Create embedding
-            response = openai.embeddings.create(
-                model="text-embedding-3-small",
-                input=chunk_text
-            )
-            embedding = response.data[0].embedding
-            
-            # Store in MongoDB
-            db.chunks.insert_one({
+        for (page, chunk_text), data in zip(batch, response.data):
+            docs.append({
                 "user_id": user_id,
                 "file_id": file_id,
-                "chunk_id": f"{file_id}_{i}",
+                "chunk_id": f"{file_id}_{count}",
                 "text": chunk_text,
-                "embedding": embedding,
+                "text_lower": chunk_text.lower(),  # Matched by case-sensitive keyword regexes
+                "embedding": data.embedding,
                 "meta": {
                     "filename": filename,
-                    "page": i // 2,  # Rough page estimate (2 chunks per page)
+                    "page": page,
                     "created_at": datetime.now()
                 }
             })
-            
-            if (i + 1) % 10 == 0:
-                print(f"Processed {i + 1}/{len(chunks)} chunks")
+            count += 1
+        
+        # Unordered inserts let the server apply the batch in parallel
+        if len(docs) >= CHUNK_INSERT_BATCH_SIZE:
+            await db.chunks.insert_many(docs, ordered=False)
+            docs.clear()
+        
+        print(f"Embedded {count} chunks")
+    
+    if docs:
+        await db.chunks.insert_many(docs, ordered=False)
+    
+    # Embedding is done; entity extraction may still be running
+    await db.files.update_one(
+        {"file_id": file_id},
+        {"$set": {"status": "building_graph"}}
+    )
+    return count
+
+
+async def _process_file(user_id: str, file_id: str, filename: str, s3_key: str, local_path: str = None):
+    """Process file in background.
+    
+    Parsing, embedding and entity extraction run as a streaming pipeline over
+    queues, so wall time is the slowest stage rather than the sum of all three.
+    """
+    client = create_openai_client()
+    graph_driver = create_neo4j_driver()
+    try:
+        print(f"Processing file: {filename} (ID: {file_id})")
         
-        # Extract entities and relationships for knowledge graph
-        print("Building knowledge graph...")
-        db.files.update_one(
+        # Update status to processing
+        await db.files.update_one(
             {"file_id": file_id},
-            {"$set": {"status": "building_graph"}}
+            {"$set": {"status": "processing"}}
         )
         
-        entities, relationships = extract_entities_and_relationships(text, file_id)
+        if not (local_path and os.path.exists(local_path)):
+            # Fallback to S3, streamed back to local disk rather than into memory
+            print(f"Downloading from S3: {s3_key}")
+            os.makedirs("temp_uploads", exist_ok=True)
+            local_path = f"temp_uploads/{file_id}_{filename}"
+            await asyncio.to_thread(download_from_s3, s3_key, local_path)
+        
+        print(f"Reading from local file: {local_path}")
+        
+        page_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        entity_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        chunk_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        tasks = [
+            asyncio.create_task(extract_pages(local_path, filename, [page_queue, entity_queue])),
+            asyncio.create_task(chunk_pages(page_queue, chunk_queue)),
+            asyncio.create_task(embed_chunks(chunk_queue, client, user_id, file_id, filename)),
+            asyncio.create_task(extract_entities_and_relationships(entity_queue, file_id, client)),
+        ]
+        try:
+            _, _, chunks_count, (entities, relationships) = await asyncio.gather(*tasks)
+        except Exception:
+            # A failed stage would leave the others blocked on their queues
+            for task in tasks:
+                task.cancel()
+            raise
+        
+        print(f"Created {chunks_count} chunks")
         
         # Store knowledge graph in MongoDB for backup
-        db.knowledge_graphs.insert_one({
+        await db.knowledge_graphs.insert_one({
             "user_id": user_id,
             "file_id": file_id,
             "entities": entities,
@@ -637,14 +1289,14 @@ def process_file(user_id: str, file_id: str, filename: str, s3_key: str, local_p
         })
         
         # Create knowledge graph in Neo4j
-        create_knowledge_graph(entities, relationships, user_id, file_id)
+        await create_knowledge_graph(entities, relationships, user_id, file_id, driver=graph_driver)
         
         # Update file status
-        db.files.update_one(
+        await db.files.update_one(
             {"file_id": file_id},
             {"$set": {
                 "status": "processed", 
-                "chunks_count": len(chunks),
+                "chunks_count": chunks_count,
                 "entities_count": len(entities),
                 "relationships_count": len(relationships)
             }}
@@ -656,16 +1308,102 @@ def process_file(user_id: str, file_id: str, filename: str, s3_key: str, local_p
         print(f"Error processing file {file_id}: {e}")
         import traceback
         traceback.print_exc()
-        db.files.update_one(
+        await db.files.update_one(
+            {"file_id": file_id},
+            {"$set": {"status": "failed", "error": str(e)}}
+        )
+    finally:
+        await graph_driver.close()
+        if not OPENAI_MOCK:
+            await client.close()
+
+
+def copy_processed_file(source: Dict, user_id: str, file_id: str, filename: str):
+    """Copy a processed file in a worker, on the worker's own event loop."""
+    asyncio.run(_copy_processed_file(source, user_id, file_id, filename))
+
+
+async def _copy_processed_file(source: Dict, user_id: str, file_id: str, filename: str):
+    """Reuse the chunks and knowledge graph of an identical, already processed file."""
+    graph_driver = create_neo4j_driver()
+    try:
+        source_file_id = source["file_id"]
+        source_user_id = source["user_id"]
+        print(f"Reusing processed file {source_file_id} for {filename} (ID: {file_id})")
+        
+        await db.files.update_one(
+            {"file_id": file_id},
+            {"$set": {"status": "processing"}}
+        )
+        
+        def rekey(value: str) -> str:
+            # Chunk and entity IDs are prefixed with the file ID they belong to
+            return file_id + value[len(source_file_id):]
+        
+        # Copy chunks, embeddings included
+        docs: List[Dict] = []
+        async for chunk in db.chunks.find({"file_id": source_file_id, "user_id": source_user_id}, {"_id": 0}):
+            chunk = {k: v for k, v in chunk.items() if k != "_id"}
+            chunk["user_id"] = user_id
+            chunk["file_id"] = file_id
+            chunk["chunk_id"] = rekey(chunk["chunk_id"])
+            chunk.setdefault("text_lower", chunk["text"].lower())
+            chunk["meta"] = {**chunk.get("meta", {}), "filename": filename, "created_at": datetime.now()}
+            docs.append(chunk)
+            
+            if len(docs) >= CHUNK_INSERT_BATCH_SIZE:
+                await db.chunks.insert_many(docs, ordered=False)
+                docs.clear()
+        
+        if docs:
+            await db.chunks.insert_many(docs, ordered=False)
+        
+        # Copy the knowledge graph backup
+        kg = await db.knowledge_graphs.find_one({"file_id": source_file_id, "user_id": source_user_id}) or {}
+        entities = [{**entity, "id": rekey(entity["id"])} for entity in kg.get("entities", [])]
+        relationships = [
+            {**rel, "source": rekey(rel["source"]), "target": rekey(rel["target"])}
+            for rel in kg.get("relationships", [])
+        ]
+        await db.knowledge_graphs.insert_one({
+            "user_id": user_id,
+            "file_id": file_id,
+            "entities": entities,
+            "relationships": relationships,
+            "created_at": datetime.now()
+        })
+        
+        # Copy the Neo4j subgraph server-side
+        await copy_file_graph(source_file_id, source_user_id, file_id, user_id, driver=graph_driver)
+        
+        await db.files.update_one(
+            {"file_id": file_id},
+            {"$set": {
+                "status": "processed",
+                "chunks_count": source.get("chunks_count", 0),
+                "entities_count": source.get("entities_count", 0),
+                "relationships_count": source.get("relationships_count", 0),
+                "copied_from": source_file_id
+            }}
+        )
+        
+        print(f"File processing complete (reused): {filename}")
+        
+    except Exception as e:
+        print(f"Error copying processed file into {file_id}: {e}")
+        import traceback
+        traceback.print_exc()
+        await db.files.update_one(
             {"file_id": file_id},
             {"$set": {"status": "failed", "error": str(e)}}
         )
+    finally:
+        await graph_driver.close()
 
 
 # Endpoints
 @app.post("/upload", response_model=UploadResponse)
 async def upload_file(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     user_id: str = Header(...),
 ):
@@ -677,41 +1415,69 @@ async def upload_file(
         # Create temp_uploads directory if it doesn't exist
         os.makedirs("temp_uploads", exist_ok=True)
         
-        # Save file locally for processing
+        # Stream the upload to disk in fixed-size chunks so memory stays flat,
+        # hashing the content on the way through
         local_path = f"temp_uploads/{file_id}_{file.filename}"
-        content = await file.read()
-        
-        with open(local_path, "wb") as f:
-            f.write(content)
-        
-        # Reset file pointer and upload to S3
-        file.file.seek(0)
-        s3_key = f"uploads/{user_id}/{file_id}/{file.filename}"
+        content_hash = hashlib.sha256()
+        async with aiofiles.open(local_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                content_hash.update(chunk)
+                await f.write(chunk)
+        content_sha256 = content_hash.hexdigest()
+        
+        # Identical content this user already processed is reused instead of reprocessed.
+        # Scoped to the uploader, so no tenant's S3 object or chunks are shared with another.
+        existing = await db.files.find_one(
+            {"user_id": user_id, "content_sha256": content_sha256, "status": "processed"},
+            {"_id": 0}
+        )
         
-        # Create a BytesIO object from content for S3 upload
-        file_obj = io.BytesIO(content)
-        s3_client.upload_fileobj(file_obj, S3_BUCKET, s3_key)
+        if existing:
+            s3_key = existing["s3_key"]
+        else:
+            # Upload to S3 from the local copy, off the event loop
+            s3_key = f"uploads/{user_id}/{file_id}/{file.filename}"
+            await asyncio.to_thread(upload_to_s3, local_path, s3_key)
         
         # Create file record
-        db.files.insert_one({
+        await db.files.insert_one({
             "user_id": user_id,
             "file_id": file_id,
             "filename": file.filename,
             "s3_key": s3_key,
             "local_path": local_path,  # Store local path for processing
+            "content_sha256": content_sha256,
             "status": "uploading",
             "created_at": datetime.now()
         })
         
-        # Process file in background
-        background_tasks.add_task(
-            process_file,
-            user_id=user_id,
-            file_id=file_id,
-            filename=file.filename,
-            s3_key=s3_key,
-            local_path=local_path
-        )
+        # Process file in the worker pool
+        if existing:
+            job = executor.submit(
+                copy_processed_file,
+                existing,
+                user_id,
+                file_id,
+                file.filename
+            )
+        else:
+            job = executor.submit(
+                process_file,
+                user_id,
+                file_id,
+                file.filename,
+                s3_key,
+                local_path
+            )
+        processing_jobs[file_id] = job
+        loop = asyncio.get_running_loop()
+        
+        def on_job_done(_):
+            processing_jobs.pop(file_id, None)
+            # Workers can't reach this process's index cache; drop the entry on the server's loop
+            loop.call_soon_threadsafe(vector_index.invalidate, user_id, file_id)
+        
+        job.add_done_callback(on_job_done)
         
         return {
             "file_id": file_id,
@@ -724,76 +1490,151 @@ async def upload_file(
 
 
 @app.get("/files")
-async def list_files(user_id: str = Header(...)):
-    """List all files for a user."""
+async def list_files(
+    user_id: str = Header(...),
+    sort: Optional[str] = Query(None, pattern="^-?created_at$"),
+    limit: Optional[int] = Query(None, ge=1)
+):
+    """List a user's files, optionally sorted by creation time ("-" for newest first) and capped."""
     try:
-        files = list(db.files.find({"user_id": user_id}, {"_id": 0}))
-        return files
+        cursor = db.files.find({"user_id": user_id}, {"_id": 0})
+        if sort:
+            cursor = cursor.sort("created_at", -1 if sort.startswith("-") else 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        files = await cursor.to_list(None)
+        # Returned directly so orjson encodes datetimes without a jsonable_encoder pass
+        return AppJSONResponse(files)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def wait_for_processing(file_id: str, user_id: str, timeout: float) -> Optional[Dict]:
+    """Block until a file is processed or failed, or the timeout passes; return its record."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        file = await db.files.find_one({"file_id": file_id, "user_id": user_id}, {"_id": 0})
+        remaining = deadline - loop.time()
+        if not file or file.get("status") in ("processed", "failed") or remaining <= 0:
+            return file
+        
+        job = processing_jobs.get(file_id)
+        try:
+            if job is not None:
+                # Shielded so a timeout never cancels the still-queued job
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job)), remaining)
+            else:
+                # Job started by another server process: fall back to a short server-side poll
+                await asyncio.sleep(min(0.5, remaining))
+        except asyncio.TimeoutError:
+            pass
+
+
 @app.get("/file/{file_id}/status")
-async def get_file_status(file_id: str, user_id: str = Header(...)):
-    """Get file processing status."""
+async def get_file_status(
+    file_id: str,
+    user_id: str = Header(...),
+    if_none_match: Optional[str] = Header(None),
+    wait: float = Query(0, ge=0, le=STATUS_WAIT_MAX_SECONDS)
+):
+    """Get file processing status; answers 304 when the client's ETag is still current.
+    
+    With wait=N the request long-polls up to N seconds for processing to finish.
+    """
     try:
-        file = db.files.find_one({"file_id": file_id, "user_id": user_id}, {"_id": 0})
+        if wait:
+            file = await wait_for_processing(file_id, user_id, wait)
+        else:
+            file = await db.files.find_one({"file_id": file_id, "user_id": user_id}, {"_id": 0})
         if not file:
             raise HTTPException(status_code=404, detail="File not found")
-        return file
+        body = orjson.dumps(file, default=_orjson_default)
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if if_none_match == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(body, media_type="application/json", headers={"ETag": etag})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def query_knowledge_graph(query: str, file_id: str, user_id: str, limit: int = 5) -> List[Dict]:
+@functools.lru_cache(maxsize=1024)
+def keyword_pattern(*terms: str) -> str:
+    """Escaped alternation of lowercased terms, for matching against text_lower."""
+    return "|".join(re.escape(term.lower()) for term in terms)
+
+
+async def text_search_chunks(query: str, file_id: str, user_id: str, limit: int) -> List[Dict]:
+    """Find a file's chunks matching the query through the text index, best matches first."""
+    if not TEXT_INDEX_READY:
+        # Case-sensitive regex on the lowercase copy instead of a case-insensitive one on text
+        return await db.chunks.find(
+            {"file_id": file_id, "user_id": user_id, "text_lower": {"$regex": keyword_pattern(query.strip())}},
+            CHUNK_PROJECTION
+        ).limit(limit).to_list(None)
+    
+    return await db.chunks.find(
+        {"file_id": file_id, "user_id": user_id, "$text": {"$search": query}},
+        {**CHUNK_PROJECTION, "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(None)
+
+
+async def retrieve_chunks(query: str, file_id: str, user_id: str, limit: int, query_embedding: Optional[List[float]] = None) -> List[Dict]:
+    """Find a file's chunks nearest to the query embedding, falling back to text search without faiss."""
+    if not FAISS_SUPPORT:
+        return await text_search_chunks(query, file_id, user_id, limit)
+    
+    if query_embedding is None:
+        response = await oai.embeddings.create(model=EMBEDDING_MODEL, input=query.strip().lower())
+        query_embedding = response.data[0].embedding
+    
+    hit_ids = await vector_index.search(user_id, file_id, query_embedding, limit)
+    if not hit_ids:
+        return []
+    chunks = await db.chunks.find(
+        {"file_id": file_id, "user_id": user_id, "chunk_id": {"$in": hit_ids}},
+        CHUNK_PROJECTION
+    ).to_list(None)
+    rank = {chunk_id: i for i, chunk_id in enumerate(hit_ids)}
+    return sorted(chunks, key=lambda chunk: rank[chunk["chunk_id"]])
+
+
+async def query_knowledge_graph(query: str, file_id: str, user_id: str, limit: int = 5) -> List[Dict]:
     """Query the knowledge graph for relevant entities and their contexts."""
     try:
         print(f"Querying knowledge graph for: {query}")
         
         # 1. Extract entities from query
         entity_extraction_prompt = f"""Extract key entities from this question. 
-Return ONLY a comma-separated list of entities, no explanations.
+Return ONLY a JSON object of the form {{"entities": ["entity name", ...]}}, no explanations.
 
-Question: {query}
-
-Entities:"""
+Question: {query}"""
         
-        response = openai.chat.completions.create(
+        response = await oai.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": entity_extraction_prompt}],
             max_tokens=100,
-            temperature=0
+            temperature=0,
+            response_format={"type": "json_object"}
         )
         
-        entities_text = response.choices[0].message.content.strip()
-        query_entities = [e.strip() for e in entities_text.split(',') if e.strip()]
+        data = orjson.loads(response.choices[0].message.content)
+        query_entities = [e.strip() for e in data.get("entities", []) if isinstance(e, str) and e.strip()]
         
         print(f"Extracted query entities: {query_entities}")
         
-        # 2. Direct search for chunks containing these entities
-        all_chunks = []
-        for entity in query_entities:
-            # Search for chunks that mention this entity
-            chunks = list(db.chunks.find({
-                "file_id": file_id,
-                "user_id": user_id,
-                "text": {"$regex": entity, "$options": "i"}
-            }).limit(2))
-            
-            print(f"Found {len(chunks)} chunks for entity '{entity}'")
-            
-            for chunk in chunks:
-                chunk["source_type"] = "knowledge_graph"  # Mark as coming from KG
-                
-                # Check if this chunk is already in all_chunks
-                is_duplicate = False
-                for existing_chunk in all_chunks:
-                    if "chunk_id" in chunk and "chunk_id" in existing_chunk and chunk["chunk_id"] == existing_chunk["chunk_id"]:
-                        is_duplicate = True
-                        break
-                
-                if not is_duplicate:
-                    all_chunks.append(chunk)
+        if not query_entities:
+            return []
+        
+        # 2. One search for chunks mentioning any of these entities
+        all_chunks = await db.chunks.find({
+            "file_id": file_id,
+            "user_id": user_id,
+            "text_lower": {"$regex": keyword_pattern(*query_entities)}
+        }, CHUNK_PROJECTION).limit(limit * 2).to_list(None)
+        
+        for chunk in all_chunks:
+            chunk["source_type"] = "knowledge_graph"  # Mark as coming from KG
         
         print(f"Found {len(all_chunks)} unique chunks from knowledge graph")
         return all_chunks[:limit]
@@ -805,124 +1646,196 @@ Entities:"""
         return []
 
 
-@app.post("/query", response_model=QueryResponse)
-async def query_file(request: QueryRequest, user_id: str = Header(...)):
-    """Query a file using hybrid retrieval (vector search + knowledge graph)."""
-    try:
-        # Get file
-        file = db.files.find_one({"file_id": request.file_id, "user_id": user_id})
-        if not file:
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        if file.get("status") != "processed":
-            return {
-                "answer": "This file is still being processed. Please try again in a moment.",
-                "sources": []
-            }
-        
-        chunks = []
-        
-        # Step 1: Knowledge graph retrieval (if enabled)
-        kg_chunks = []
-        if request.use_kg:
-            print("Using knowledge graph for retrieval...")
-            kg_chunks = query_knowledge_graph(request.query, request.file_id, user_id, limit=3)
-            chunks.extend(kg_chunks)
-            print(f"Found {len(kg_chunks)} chunks from knowledge graph")
-        
-        # Step 2: Vector/keyword search for relevant chunks
-        vector_chunks = list(db.chunks.find({
-            "file_id": request.file_id,
+async def save_chat_history(request: QueryRequest, user_id: str, answer: str) -> None:
+    """Save a chat exchange if the request belongs to a session."""
+    if request.session_id:
+        await db.chat_history.insert_one({
             "user_id": user_id,
-            "text": {"$regex": request.query, "$options": "i"}
-        }).limit(3))
-        
-        # Mark each chunk as coming from vector search
-        for chunk in vector_chunks:
-            chunk["source_type"] = "vector_search"
-            
-        print(f"Found {len(vector_chunks)} chunks from keyword search")
-        
-        # Combine results, avoiding duplicates
-        for chunk in vector_chunks:
-            # Check if this chunk is already in the results
-            is_duplicate = False
-            for existing_chunk in chunks:
-                if "chunk_id" in chunk and "chunk_id" in existing_chunk and chunk["chunk_id"] == existing_chunk["chunk_id"]:
-                    is_duplicate = True
-                    break
-                    
-            if not is_duplicate:
-                chunks.append(chunk)
-        
-        # Fallback if no chunks found
-        if not chunks:
-            print("No chunks found, falling back to any chunks from this file")
-            chunks = list(db.chunks.find({
-                "file_id": request.file_id,
-                "user_id": user_id
-            }).limit(5))
-        
-        # Create context from chunks
-        context = "\n\n".join([chunk["text"] for chunk in chunks])
+            "file_id": request.file_id,
+            "session_id": request.session_id,
+            "query": request.query,
+            "answer": answer,
+            "created_at": datetime.now(),
+            "used_kg": request.use_kg
+        })
+
+
+async def prepare_query(request: QueryRequest, user_id: str) -> Dict[str, Any]:
+    """Resolve a query to a ready answer, or to the prompt and sources for generating one.
+    
+    Returns {"answer", "sources"} when no model call is needed (file still
+    processing, or a cache hit), otherwise {"messages", "sources", "cache_entry"}.
+    """
+    # Get file
+    file = await db.files.find_one({"file_id": request.file_id, "user_id": user_id})
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    if file.get("status") != "processed":
+        return {
+            "answer": "This file is still being processed. Please try again in a moment.",
+            "sources": []
+        }
+    
+    # temperature=0 answers are deterministic, so repeated questions are served from cache
+    normalized_query = request.query.strip().lower()
+    query_hash = hashlib.sha256(
+        f"{CHAT_MODEL}|{request.file_id}|{int(request.use_kg)}|{normalized_query}".encode()
+    ).hexdigest()
+    cache_filter = {"user_id": user_id, "file_id": request.file_id}
+    cached = await db.chat_cache.find_one({**cache_filter, "query_hash": query_hash})
+    
+    query_embedding = None
+    if not cached and FAISS_SUPPORT:
+        embedding_response = await oai.embeddings.create(model=EMBEDDING_MODEL, input=normalized_query)
+        query_embedding = embedding_response.data[0].embedding
+        similar_hash = semantic_cache.search(user_id, request.file_id, request.use_kg, query_embedding)
+        if similar_hash:
+            cached = await db.chat_cache.find_one({**cache_filter, "query_hash": similar_hash})
+    
+    if cached:
+        print(f"Answer served from cache for: {request.query}")
+        await save_chat_history(request, user_id, cached["answer"])
+        return {
+            "answer": cached["answer"],
+            "sources": cached["sources"]
+        }
+    
+    chunks = []
+    
+    # Step 1: Knowledge graph retrieval (if enabled)
+    kg_chunks = []
+    if request.use_kg:
+        print("Using knowledge graph for retrieval...")
+        kg_chunks = await query_knowledge_graph(request.query, request.file_id, user_id, limit=3)
+        chunks.extend(kg_chunks)
+        print(f"Found {len(kg_chunks)} chunks from knowledge graph")
+    
+    # Step 2: Vector search for relevant chunks ($text-ranked keyword search without faiss)
+    vector_chunks = await retrieve_chunks(request.query, request.file_id, user_id, limit=3, query_embedding=query_embedding)
+    
+    # Mark each chunk as coming from vector search
+    for chunk in vector_chunks:
+        chunk["source_type"] = "vector_search"
         
-        # Generate answer with OpenAI
-        prompt = f"""Based on the following context, answer the question.
+    print(f"Found {len(vector_chunks)} chunks from vector search")
+    
+    # Combine results, avoiding duplicates
+    seen_ids = {chunk["chunk_id"] for chunk in chunks if "chunk_id" in chunk}
+    for chunk in vector_chunks:
+        if "chunk_id" not in chunk:
+            chunks.append(chunk)
+        elif chunk["chunk_id"] not in seen_ids:
+            chunks.append(chunk)
+            seen_ids.add(chunk["chunk_id"])
+    
+    # Fallback if no chunks found; fetched only then, so matched queries make no extra round-trip
+    if not chunks:
+        print("No chunks found, falling back to any chunks from this file")
+        chunks = await db.chunks.find({
+            "file_id": request.file_id,
+            "user_id": user_id
+        }, CHUNK_PROJECTION).limit(5).to_list(None)
+    
+    # Create context from chunks in a stable order, so repeated queries share a prompt prefix
+    buf = io.StringIO()
+    for i, chunk in enumerate(sorted(chunks, key=lambda chunk: chunk.get("chunk_id", ""))):
+        if i:
+            buf.write("\n\n")
+        buf.write(chunk["text"])
+    context = buf.getvalue()
+    
+    # The mutable question goes last
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Context:\n{context}"},
+        {"role": "user", "content": f"Question: {request.query}"}
+    ]
+    
+    # Candidate entity words from the query, tokenized once for all sources
+    query_tokens = [(word, word.lower()) for word in re.findall(r"\w+", request.query) if len(word) > 3]
+    
+    # Format sources
+    sources = [None] * len(chunks)
+    for i, chunk in enumerate(chunks):
+        # Get source type directly from the chunk if available
+        source_type = chunk.get("source_type", "vector_search")
+        
+        # For knowledge graph sources, add relationship info
+        source_info = ""
+        if source_type == "knowledge_graph":
+            # Extract a potential entity from the query
+            chunk_tokens = set(re.findall(r"\w+", chunk["text"].lower()))
+            entity_name = next((word for word, word_lower in query_tokens if word_lower in chunk_tokens), None)
+            if entity_name:
+                source_info = f"[KG: {entity_name}]"
+        
+        sources[i] = {
+            "chunk_id": chunk["chunk_id"],
+            "text": f"{source_info} {chunk['text'][:200]}..." if source_info else f"{chunk['text'][:200]}...",
+            "page": chunk["meta"].get("page", 0),
+            "filename": chunk["meta"].get("filename", "unknown"),
+            "source_type": source_type
+        }
+    
+    return {
+        "messages": messages,
+        "sources": sources,
+        "cache_entry": {
+            **cache_filter,
+            "query_hash": query_hash,
+            "query": request.query,
+            "use_kg": request.use_kg,
+            "embedding": query_embedding
+        }
+    }
 
-Context:
-{context}
 
-Question: {request.query}
+def trim_sources(sources: List[Dict[str, Any]], max_chars: Optional[int]) -> List[Dict[str, Any]]:
+    """Cut each source preview to max_chars, leaving the cached sources untouched."""
+    if max_chars is None:
+        return sources
+    return [{**source, "text": source["text"][:max_chars]} for source in sources]
 
-Answer:"""
+
+async def finish_query(request: QueryRequest, user_id: str, prepared: Dict[str, Any], answer: str) -> None:
+    """Record a generated answer in the chat history and the response cache."""
+    await save_chat_history(request, user_id, answer)
+    
+    cache_entry = prepared["cache_entry"]
+    await db.chat_cache.insert_one({
+        **cache_entry,
+        "answer": answer,
+        "sources": prepared["sources"],
+        "created_at": datetime.now()
+    })
+    if cache_entry["embedding"]:
+        semantic_cache.add(user_id, request.file_id, request.use_kg, cache_entry["query_hash"], cache_entry["embedding"])
+
+
+@app.post("/query", response_model=QueryResponse)
+async def query_file(request: QueryRequest, user_id: str = Header(...)):
+    """Query a file using hybrid retrieval (vector search + knowledge graph)."""
+    try:
+        prepared = await prepare_query(request, user_id)
+        if "answer" in prepared:
+            return {"answer": prepared["answer"], "sources": trim_sources(prepared["sources"], request.max_chars)}
         
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+        # Generate answer with OpenAI
+        response = await oai.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=prepared["messages"],
             max_tokens=500,
             temperature=0
         )
         
         answer = response.choices[0].message.content
         
-        # Save chat history if session_id provided
-        if request.session_id:
-            db.chat_history.insert_one({
-                "user_id": user_id,
-                "file_id": request.file_id,
-                "session_id": request.session_id,
-                "query": request.query,
-                "answer": answer,
-                "created_at": datetime.now(),
-                "used_kg": request.use_kg
-            })
-        
-        # Format sources
-        sources = []
-        for chunk in chunks:
-            # Get source type directly from the chunk if available
-            source_type = chunk.get("source_type", "vector_search")
-            
-            # For knowledge graph sources, add relationship info
-            source_info = ""
-            if source_type == "knowledge_graph":
-                # Extract a potential entity from the query
-                query_words = request.query.split()
-                entity_name = next((word for word in query_words if len(word) > 3 and word.lower() in chunk["text"].lower()), None)
-                if entity_name:
-                    source_info = f"[KG: {entity_name}]"
-            
-            sources.append({
-                "chunk_id": chunk["chunk_id"],
-                "text": (source_info + " " if source_info else "") + chunk["text"][:200] + "...",
-                "page": chunk["meta"].get("page", 0),
-                "filename": chunk["meta"].get("filename", "unknown"),
-                "source_type": source_type
-            })
+        await finish_query(request, user_id, prepared, answer)
         
         return {
             "answer": answer,
-            "sources": sources
+            "sources": trim_sources(prepared["sources"], request.max_chars)
         }
         
     except Exception as e:
@@ -932,18 +1845,84 @@ Answer:"""
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/chat-history/{file_id}")
-async def get_chat_history(file_id: str, session_id: Optional[str] = None, user_id: str = Header(...)):
-    """Get chat history for a file."""
+def sse_event(data: Any, event: Optional[str] = None) -> bytes:
+    """Format a server-sent event; data is JSON so newlines in tokens stay inside one event."""
+    prefix = f"event: {event}\n".encode() if event else b""
+    return prefix + b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.post("/query/stream")
+async def query_file_stream(request: QueryRequest, user_id: str = Header(...)):
+    """Query a file, streaming answer tokens as server-sent events.
+    
+    Each token is a `data:` event carrying a JSON string; a final `sources`
+    event carries the sources list.
+    """
     try:
-        query = {"file_id": file_id, "user_id": user_id}
-        if session_id:
-            query["session_id"] = session_id
-            
-        history = list(db.chat_history.find(query, {"_id": 0}).sort("created_at", -1))
-        return history
+        prepared = await prepare_query(request, user_id)
     except Exception as e:
+        print(f"Error in streaming query endpoint: {e}")
+        import traceback
+        traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    
+    async def events():
+        try:
+            if "answer" in prepared:
+                yield sse_event(prepared["answer"])
+            else:
+                stream = await oai.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=prepared["messages"],
+                    max_tokens=500,
+                    temperature=0,
+                    stream=True
+                )
+                
+                parts = []
+                async for chunk in stream:
+                    token = chunk.choices[0].delta.content if chunk.choices else None
+                    if token:
+                        parts.append(token)
+                        yield sse_event(token)
+                
+                await finish_query(request, user_id, prepared, "".join(parts))
+            
+            yield sse_event(trim_sources(prepared["sources"], request.max_chars), event="sources")
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            print(f"Error streaming query response: {e}")
+            yield sse_event(str(e), event="error")
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/chat-history/{file_id}")
+async def get_chat_history(
+    file_id: str,
+    session_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    user_id: str = Header(...)
+):
+    """Get the most recent chat history for a file, streamed as a JSON array."""
+    query = {"file_id": file_id, "user_id": user_id}
+    if session_id:
+        query["session_id"] = session_id
+    
+    cursor = db.chat_history.find(
+        query,
+        {"_id": 0, "query": 1, "answer": 1, "created_at": 1, "session_id": 1}
+    ).sort("created_at", -1).limit(limit)
+    
+    async def stream_history():
+        yield b"["
+        first = True
+        async for entry in cursor:
+            yield (b"" if first else b",") + orjson.dumps(entry, default=_orjson_default)
+            first = False
+        yield b"]"
+    
+    return StreamingResponse(stream_history(), media_type="application/json")
 
 
 @app.get("/graph/{file_id}", response_model=GraphResponse)
@@ -951,46 +1930,11 @@ async def get_knowledge_graph(file_id: str, user_id: str = Header(...)):
     """Get knowledge graph for visualization."""
     try:
         # Check if file exists
-        file = db.files.find_one({"file_id": file_id, "user_id": user_id})
+        file = await db.files.find_one({"file_id": file_id, "user_id": user_id})
         if not file:
             raise HTTPException(status_code=404, detail="File not found")
         
-        nodes = []
-        edges = []
-        
-        with neo4j_driver.session() as session:
-            # Get entities (nodes)
-            result = session.run("""
-                MATCH (e:Entity)
-                WHERE e.file_id = $file_id AND e.user_id = $user_id
-                RETURN e.id AS id, e.name AS name, e.type AS type, e.mentions AS mentions
-                LIMIT 100
-            """, file_id=file_id, user_id=user_id)
-            
-            for record in result:
-                nodes.append({
-                    "id": record["id"],
-                    "label": record["name"],
-                    "type": record["type"],
-                    "mentions": record["mentions"],
-                    "size": len(record["mentions"]) * 5  # Size based on mention count
-                })
-            
-            # Get relationships (edges)
-            result = session.run("""
-                MATCH (e1:Entity)-[r:RELATIONSHIP]->(e2:Entity)
-                WHERE e1.file_id = $file_id AND e1.user_id = $user_id
-                RETURN e1.id AS source, e2.id AS target, r.type AS type, r.context AS context
-                LIMIT 500
-            """, file_id=file_id, user_id=user_id)
-            
-            for record in result:
-                edges.append({
-                    "source": record["source"],
-                    "target": record["target"],
-                    "label": record["type"],
-                    "context": record["context"]
-                })
+        nodes, edges = await read_file_graph(file_id, user_id)
         
         return {
             "nodes": nodes,
@@ -1004,23 +1948,6 @@ async def get_knowledge_graph(file_id: str, user_id: str = Header(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/files")
-async def list_files(user_id: str = Header(...)):
-    """List all files for a user."""
-    try:
-        files = list(db.files.find({"user_id": user_id}))
-        # Convert ObjectId to string if present
-        for file in files:
-            if "_id" in file:
-                file["_id"] = str(file["_id"])
-        return files
-    except Exception as e:
-        print(f"Error listing files: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
-
-
 @app.post("/debug/kg")
 async def debug_kg(request: Dict[str, Any], user_id: str = Header(...)):
     """Debug knowledge graph retrieval."""
@@ -1032,14 +1959,10 @@ async def debug_kg(request: Dict[str, Any], user_id: str = Header(...)):
             return {"error": "Missing file_id or query"}
         
         # Get knowledge graph chunks directly
-        kg_chunks = query_knowledge_graph(query, file_id, user_id, limit=5)
+        kg_chunks = await query_knowledge_graph(query, file_id, user_id, limit=5)
         
         # Get direct search chunks
-        vector_chunks = list(db.chunks.find({
-            "file_id": file_id,
-            "user_id": user_id,
-            "text": {"$regex": query, "$options": "i"}
-        }).limit(5))
+        vector_chunks = await retrieve_chunks(query, file_id, user_id, limit=5)
         
         # Format results
         kg_results = []
@@ -1074,6 +1997,54 @@ async def debug_kg(request: Dict[str, Any], user_id: str = Header(...)):
         return {"error": str(e)}
 
 
+# Collections the explain endpoint may inspect
+EXPLAIN_COLLECTIONS = {"files", "chunks", "chat_history", "chat_cache", "knowledge_graphs"}
+
+
+def _plan_stages(plan: Dict) -> List[str]:
+    """Flatten a winning plan into its stage names, outermost first."""
+    stages = [plan.get("stage", "UNKNOWN")]
+    if "inputStage" in plan:
+        stages += _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+
+@app.post("/admin/explain")
+async def explain_query(request: Dict[str, Any], admin_token: Optional[str] = Header(None)):
+    """Explain a find on one of the app's collections, to catch queries that stopped using an index.
+    
+    Requires the admin-token header to match ADMIN_TOKEN; disabled when it is unset.
+    """
+    expected = os.getenv("ADMIN_TOKEN")
+    if not expected or not hmac.compare_digest((admin_token or "").encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    
+    collection = request.get("collection")
+    if collection not in EXPLAIN_COLLECTIONS:
+        raise HTTPException(status_code=400, detail=f"collection must be one of {sorted(EXPLAIN_COLLECTIONS)}")
+    
+    try:
+        explain = await db.command(
+            {"explain": {"find": collection, "filter": request.get("filter", {})}, "verbosity": "executionStats"}
+        )
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        stats = explain["executionStats"]
+        return {
+            "collection": collection,
+            "stages": stages,
+            "uses_index": "COLLSCAN" not in stages,
+            "n_returned": stats.get("nReturned"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "docs_examined": stats.get("totalDocsExamined"),
+            "execution_time_ms": stats.get("executionTimeMillis")
+        }
+    except Exception as e:
+        print(f"Error explaining query: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -1,5 +1,6 @@
 import streamlit as st
-import requests
+import httpx
+import json
 import time
 import os
 from typing import List, Dict
@@ -22,18 +23,22 @@ if "current_file_id" not in st.session_state:
     st.session_state.current_file_id = None
 if "current_filename" not in st.session_state:
     st.session_state.current_filename = None
+if "http_client" not in st.session_state:
+    # One keep-alive client per session, so requests reuse the same connection
+    st.session_state.http_client = httpx.Client(
+        base_url=API_BASE_URL,
+        headers={"user-id": USER_ID},
+        http2=True,
+        timeout=30.0
+    )
+client = st.session_state.http_client
 
 def upload_file(file) -> Dict:
     """Upload file to the API."""
     try:
         files = {"file": (file.name, file.getvalue(), file.type)}
-        headers = {"user-id": USER_ID}
         
-        response = requests.post(
-            f"{API_BASE_URL}/upload",
-            files=files,
-            headers=headers
-        )
+        response = client.post("/upload", files=files)
         
         if response.status_code == 200:
             return response.json()
@@ -47,10 +52,7 @@ def upload_file(file) -> Dict:
 def get_file_status(file_id: str) -> Dict:
     """Get file processing status."""
     try:
-        response = requests.get(
-            f"{API_BASE_URL}/file/{file_id}/status",
-            headers={"user-id": USER_ID}
-        )
+        response = client.get(f"/file/{file_id}/status")
         
         if response.status_code == 200:
             return response.json()
@@ -59,34 +61,47 @@ def get_file_status(file_id: str) -> Dict:
     except:
         return {"status": "error"}
 
-def query_document(query: str, file_id: str, use_kg: bool = True) -> Dict:
-    """Query the document."""
+def stream_query(query: str, file_id: str, result: Dict, use_kg: bool = True):
+    """Yield answer tokens from the streaming query endpoint.
+    
+    The sources sent at the end of the stream are stored in result["sources"].
+    """
     try:
-        response = requests.post(
-            f"{API_BASE_URL}/query",
-            headers={"user-id": USER_ID},
+        with client.stream(
+            "POST",
+            "/query/stream",
             json={
                 "query": query,
                 "file_id": file_id,
                 "session_id": "streamlit_session",
                 "use_kg": use_kg
             }
-        )
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return {"answer": f"Query failed: {response.status_code}", "sources": []}
+        ) as response:
+            if response.status_code != 200:
+                yield f"Query failed: {response.status_code}"
+                return
+            
+            event = "message"
+            for line in response.iter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):])
+                    if event == "sources":
+                        result["sources"] = data
+                    elif event == "error":
+                        yield f"Query error: {data}"
+                    else:
+                        yield data
+                elif not line:
+                    event = "message"
     except Exception as e:
-        return {"answer": f"Query error: {str(e)}", "sources": []}
+        yield f"Query error: {str(e)}"
 
 def get_user_files() -> List[Dict]:
     """Get list of user's files."""
     try:
-        response = requests.get(
-            f"{API_BASE_URL}/files",
-            headers={"user-id": USER_ID}
-        )
+        response = client.get("/files")
         
         if response.status_code == 200:
             return response.json()
@@ -181,13 +196,13 @@ if st.session_state.current_file_id:
             with st.chat_message("user"):
                 st.write(prompt)
             
-            # Get AI response
+            # Stream AI response as it is generated
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    response = query_document(prompt, st.session_state.current_file_id)
-                
-                answer = response.get("answer", "Sorry, I couldn't generate a response.")
-                st.write(answer)
+                response = {}
+                answer = st.write_stream(stream_query(prompt, st.session_state.current_file_id, response))
+                if not answer:
+                    answer = "Sorry, I couldn't generate a response."
+                    st.write(answer)
                 
                 # Show sources
                 sources = response.get("sources", [])
@@ -204,15 +219,16 @@ if st.session_state.current_file_id:
                     "sources": sources
                 })
     
-    elif file_status["status"] == "processing":
+    elif file_status["status"] in ("processing", "building_graph"):
         st.info(f"⏳ {st.session_state.current_filename} is being processed...")
         
         # Show processing progress
         progress_bar = st.progress(0)
         status_text = st.empty()
         
-        # Poll for status updates
-        for i in range(30):  # Wait up to 30 seconds
+        # Poll for status updates with exponential backoff
+        started = time.monotonic()
+        for attempt in range(30):
             file_status = get_file_status(st.session_state.current_file_id)
             
             if file_status["status"] == "processed":
@@ -223,10 +239,13 @@ if st.session_state.current_file_id:
             elif file_status["status"] == "failed":
                 st.error(f"❌ Processing failed: {file_status.get('error', 'Unknown error')}")
                 break
+            elif time.monotonic() - started > 120:  # Stop polling after 2 minutes
+                status_text.text("Still processing. Refresh the page to check again.")
+                break
             else:
-                progress_bar.progress(min(90, (i + 1) * 3))
+                progress_bar.progress(min(90, (attempt + 1) * 10))
                 status_text.text(f"Processing... ({file_status['status']})")
-                time.sleep(1)
+                time.sleep(min(5, 0.5 * 2 ** attempt))
     
     elif file_status["status"] == "failed":
         st.error(f"❌ {st.session_state.current_filename} processing failed: {file_status.get('error', 'Unknown error')}")
@@ -274,13 +293,8 @@ else:
         # Upload it
         with open("sample_demo.txt", "rb") as f:
             files = {"file": ("sample_demo.txt", f.read(), "text/plain")}
-            headers = {"user-id": USER_ID}
             
-            response = requests.post(
-                f"{API_BASE_URL}/upload",
-                files=files,
-                headers=headers
-            )
+            response = client.post("/upload", files=files)
             
             if response.status_code == 200:
                 result = response.json()
@@ -1,10 +1,12 @@
 """Add test data directly to the mock database."""
-import requests
+from _http import make_session
 import json
 
 BASE_URL = "http://localhost:8000"
 USER_ID = "test_user_123"
 
+session = make_session(USER_ID)
+
 def add_mock_data():
     """Add test data directly to the mock database."""
     print("Adding test data to mock database\n")
@@ -12,9 +14,8 @@ def add_mock_data():
     # 1. Upload a file to get a file_id
     print("1. Uploading test file...")
     with open("test-kg.txt", "rb") as f:
-        response = requests.post(
+        response = session.post(
             f"{BASE_URL}/upload",
-            headers={"user-id": USER_ID},
             files={"file": ("test-kg.txt", f)}
         )
     
@@ -28,10 +29,7 @@ def add_mock_data():
     # 2. Wait for processing to complete
     print("\n2. Waiting for processing to complete...")
     for i in range(10):
-        response = requests.get(
-            f"{BASE_URL}/file/{file_id}/status",
-            headers={"user-id": USER_ID}
-        )
+        response = session.get(f"{BASE_URL}/file/{file_id}/status")
         
         status = response.json().get("status")
         print(f"Status: {status}")
@@ -44,9 +42,8 @@ def add_mock_data():
     
     # 3. Test search with direct query
     print("\n3. Testing search with direct query...")
-    response = requests.post(
+    response = session.post(
         f"{BASE_URL}/query",
-        headers={"user-id": USER_ID, "Content-Type": "application/json"},
         json={
             "query": "Machine Learning",
             "file_id": file_id,
@@ -61,9 +58,8 @@ def add_mock_data():
     
     # 4. Test debug endpoint
     print("\n4. Testing debug endpoint...")
-    response = requests.post(
+    response = session.post(
         f"{BASE_URL}/debug/kg",
-        headers={"user-id": USER_ID, "Content-Type": "application/json"},
         json={
             "query": "Machine Learning",
             "file_id": file_id
@@ -78,4 +74,5 @@ def add_mock_data():
     print("\nTest completed!")
 
 if __name__ == "__main__":
-    add_mock_data()
+    with session:
+        add_mock_data()
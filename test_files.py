@@ -1,17 +1,17 @@
 """Test the /files endpoint."""
-import requests
+from _http import make_session
+
+session = make_session("test_user_123")
 
 def test_files():
     """Test the /files endpoint."""
     print("Testing /files endpoint")
     
-    response = requests.get(
-        "http://localhost:8000/files",
-        headers={"user-id": "test_user_123"}
-    )
+    response = session.get("http://localhost:8000/files")
     
     print(f"Status code: {response.status_code}")
     print(f"Response: {response.text}")
 
 if __name__ == "__main__":
-    test_files()
+    with session:
+        test_files()
@@ -3,12 +3,35 @@ import asyncio
 import os
 from datetime import datetime
 from dotenv import load_dotenv
-from pymongo import MongoClient
-import openai
+from pymongo import MongoClient, WriteConcern
+from openai import AsyncOpenAI
 
 # Load environment variables
 load_dotenv()
 
+# Inputs per embeddings request (API maximum) and requests in flight at once
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_CONCURRENCY = 16
+
+
+async def embed_chunks(client: AsyncOpenAI, chunks):
+    """Embed chunks in batches, running up to EMBEDDING_CONCURRENCY requests concurrently."""
+    sem = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    
+    async def embed_batch(batch):
+        async with sem:
+            response = await client.embeddings.create(
+                model="text-embedding-3-small",
+                input=batch
+            )
+            # Results come back in input order
+            return [item.embedding for item in response.data]
+    
+    batches = [chunks[i:i+EMBEDDING_BATCH_SIZE] for i in range(0, len(chunks), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+    return [embedding for batch in results for embedding in batch]
+
+
 async def test_ingestion_step_by_step():
     """Test ingestion system step by step."""
     print("Testing Ingestion System Step by Step\n")
@@ -46,16 +69,11 @@ async def test_ingestion_step_by_step():
         
         # 4. Test embeddings
         print("\n4. Testing embeddings...")
-        openai.api_key = os.getenv("OPENAI_API_KEY")
+        openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
-        embeddings = []
-        for i, chunk in enumerate(chunks[:2]):  # Test first 2 chunks
-            response = openai.embeddings.create(
-                model="text-embedding-3-small",
-                input=chunk
-            )
-            embedding = response.data[0].embedding
-            embeddings.append(embedding)
+        test_chunks = chunks[:2]  # Test first 2 chunks
+        embeddings = await embed_chunks(openai_client, test_chunks)
+        for i, embedding in enumerate(embeddings):
             print(f"   SUCCESS: Chunk {i+1} embedded: {len(embedding)} dimensions")
         
         # 5. Test database insertion
@@ -76,9 +94,10 @@ async def test_ingestion_step_by_step():
         file_result = db.files.insert_one(file_doc)
         print(f"SUCCESS: File inserted: {file_result.inserted_id}")
         
-        # Insert chunks
-        for i, (chunk, embedding) in enumerate(zip(chunks[:2], embeddings)):
-            chunk_doc = {
+        # Insert chunks in one unordered batch, acknowledged once by the primary
+        chunk_docs = []
+        for i, (chunk, embedding) in enumerate(zip(test_chunks, embeddings)):
+            chunk_docs.append({
                 "user_id": "u1",
                 "file_id": "test-file-123",
                 "chunk_id": f"chunk_{i}",
@@ -92,10 +111,11 @@ async def test_ingestion_step_by_step():
                 },
                 "created_at": datetime.now(),
                 "updated_at": datetime.now()
-            }
-            
-            chunk_result = db.chunks.insert_one(chunk_doc)
-            print(f"   SUCCESS: Chunk {i+1} inserted: {chunk_result.inserted_id}")
+            })
+        
+        chunks_collection = db.get_collection("chunks", write_concern=WriteConcern(w=1, j=False))
+        chunk_result = chunks_collection.insert_many(chunk_docs, ordered=False, bypass_document_validation=True)
+        print(f"   SUCCESS: {len(chunk_result.inserted_ids)} chunks inserted")
         
         # 6. Test retrieval
         print("\n6. Testing retrieval...")
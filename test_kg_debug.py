@@ -1,37 +1,25 @@
 """Test the knowledge graph debug endpoint."""
-import requests
+from _http import make_session, resolve_file_id
 import json
 
 BASE_URL = "http://localhost:8000"
 USER_ID = "test_user_123"
 
+session = make_session(USER_ID)
+
 def test_kg_debug():
     """Test the knowledge graph debug endpoint."""
     print("Testing Knowledge Graph Debug Endpoint\n")
     
-    # Get list of files
-    print("1. Getting list of files...")
-    response = requests.get(
-        f"{BASE_URL}/files",
-        headers={"user-id": USER_ID}
-    )
-    
-    if response.status_code != 200:
-        print(f"Failed to get files: {response.status_code}")
-        return
-    
-    files = response.json()
-    print(f"Found {len(files)} files")
+    # Use $MESHMIND_FILE_ID or the last file used; only ask the server when neither is set
+    print("1. Resolving file...")
+    file_id = resolve_file_id(session, base_url=BASE_URL)
     
-    if not files:
+    if not file_id:
         print("No files found. Please run test_kg_simple.py first.")
         return
     
-    # Use the most recent file
-    # Sort files by creation time (most recent first)
-    files.sort(key=lambda f: f.get("created_at", ""), reverse=True)
-    file_id = files[0]["file_id"]
-    print(f"Using file: {file_id} ({files[0]['filename']})")
+    print(f"Using file: {file_id}")
     
     # Test specific entity-focused queries
     print("\n2. Testing entity-focused queries with debug endpoint...")
@@ -46,9 +34,8 @@ def test_kg_debug():
         print(f"\nQuery: {query}")
         
         # Call the debug endpoint
-        response = requests.post(
+        response = session.post(
             f"{BASE_URL}/debug/kg",
-            headers={"user-id": USER_ID, "Content-Type": "application/json"},
             json={
                 "query": query,
                 "file_id": file_id
@@ -74,4 +61,5 @@ def test_kg_debug():
     print("\nTest completed!")
 
 if __name__ == "__main__":
-    test_kg_debug()
+    with session:
+        test_kg_debug()
@@ -1,48 +1,35 @@
 """Test direct knowledge graph querying."""
-import requests
-import json
+from _http import cached_get, cached_query, make_session, resolve_file_id
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 BASE_URL = "http://localhost:8000"
 USER_ID = "test_user_123"
 
+session = make_session(USER_ID)
+
 def test_kg_direct():
     """Test direct knowledge graph querying."""
     print("Testing Direct Knowledge Graph Querying\n")
     
-    # Get list of files
-    print("1. Getting list of files...")
-    response = requests.get(
-        f"{BASE_URL}/files",
-        headers={"user-id": USER_ID}
-    )
-    
-    if response.status_code != 200:
-        print(f"Failed to get files: {response.status_code}")
-        return
-    
-    files = response.json()
-    print(f"Found {len(files)} files")
+    # Use $MESHMIND_FILE_ID or the last file used; only ask the server when neither is set
+    print("1. Resolving file...")
+    file_id = resolve_file_id(session, base_url=BASE_URL)
     
-    if not files:
+    if not file_id:
         print("No files found. Please run test_kg_simple.py first.")
         return
     
-    # Use the most recent file
-    file_id = files[0]["file_id"]
-    print(f"Using file: {file_id} ({files[0]['filename']})")
+    print(f"Using file: {file_id}")
     
     # Get knowledge graph
     print("\n2. Getting knowledge graph...")
-    response = requests.get(
-        f"{BASE_URL}/graph/{file_id}",
-        headers={"user-id": USER_ID}
-    )
+    graph = cached_get(session, f"{BASE_URL}/graph/{file_id}")
     
-    if response.status_code != 200:
-        print(f"Failed to get graph: {response.status_code}")
+    if graph is None:
+        print("Failed to get graph")
         return
     
-    graph = response.json()
     print(f"Graph has {len(graph['nodes'])} nodes and {len(graph['edges'])} edges")
     
     # Print all entities and relationships
@@ -63,31 +50,43 @@ def test_kg_direct():
         "What is BERT used for?"
     ]
     
+    # Call the API directly with debug info, all queries in flight at once
+    results = {}
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        futures = {
+            executor.submit(
+                cached_query,
+                session,
+                {
+                    "query": query,
+                    "file_id": file_id,
+                    "session_id": "test_direct",
+                    "use_kg": True
+                },
+                base_url=BASE_URL
+            ): query
+            for query in entity_queries
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    
     for query in entity_queries:
         print(f"\nQuery: {query}")
+        result = results[query]
         
-        # Call the API directly with debug info
-        response = requests.post(
-            f"{BASE_URL}/query",
-            headers={"user-id": USER_ID, "Content-Type": "application/json"},
-            json={
-                "query": query,
-                "file_id": file_id,
-                "session_id": "test_direct",
-                "use_kg": True
-            }
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
+        if result is not None:
             answer = result["answer"]
             sources = result["sources"]
             
             print(f"Answer: {answer[:150]}...")
             print(f"Sources: {len(sources)}")
             
-            kg_sources = [s for s in sources if s["source_type"] == "knowledge_graph"]
-            vector_sources = [s for s in sources if s["source_type"] == "vector_search"]
+            # Group sources by type in a single pass
+            buckets = defaultdict(list)
+            for s in sources:
+                buckets[s.get("source_type")].append(s)
+            kg_sources = buckets["knowledge_graph"]
+            vector_sources = buckets["vector_search"]
             
             print(f"Knowledge graph sources: {len(kg_sources)}")
             print(f"Vector search sources: {len(vector_sources)}")
@@ -97,10 +96,10 @@ def test_kg_direct():
                 for source in kg_sources:
                     print(f"  - {source['text'][:100]}...")
         else:
-            print(f"Query failed: {response.status_code}")
-            print(response.text)
+            print("Query failed")
     
     print("\nTest completed!")
 
 if __name__ == "__main__":
-    test_kg_direct()
+    with session:
+        test_kg_direct()
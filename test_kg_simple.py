@@ -1,11 +1,13 @@
 """Test knowledge graph creation with a simple text file."""
-import requests
-import time
+from _http import cached_query, make_session, poll_status, remember_file_id
 import json
+from collections import defaultdict
 
 BASE_URL = "http://localhost:8000"
 USER_ID = "test_user_123"
 
+session = make_session(USER_ID)
+
 def test_kg_simple():
     """Test knowledge graph creation with a simple text file."""
     print("Testing Knowledge Graph Creation with Simple Text File\n")
@@ -16,9 +18,8 @@ def test_kg_simple():
     try:
         with open(text_file, "rb") as f:
             print(f"1. Uploading text file: {text_file}")
-            response = requests.post(
+            response = session.post(
                 f"{BASE_URL}/upload",
-                headers={"user-id": USER_ID},
                 files={"file": (text_file, f)}
             )
             
@@ -29,42 +30,29 @@ def test_kg_simple():
             
             result = response.json()
             file_id = result["file_id"]
+            remember_file_id(file_id)
             print(f"   File uploaded: {file_id}")
             print(f"   Status: {result['status']}\n")
         
         # 2. Check processing status
         print("2. Checking processing status...")
-        for i in range(20):  # Wait up to 40 seconds
-            response = requests.get(
-                f"{BASE_URL}/file/{file_id}/status",
-                headers={"user-id": USER_ID}
-            )
-            
-            status_data = response.json()
-            status = status_data.get("status")
-            print(f"   Attempt {i+1}: Status = {status}")
-            
-            if status == "processed":
-                entities_count = status_data.get("entities_count", 0)
-                relationships_count = status_data.get("relationships_count", 0)
-                print(f"   SUCCESS! File processed with:")
-                print(f"     - {status_data.get('chunks_count', 0)} chunks")
-                print(f"     - {entities_count} entities")
-                print(f"     - {relationships_count} relationships\n")
-                break
-            elif status == "failed":
-                error = status_data.get("error", "Unknown error")
-                print(f"   FAILED: {error}\n")
-                return
-            
-            time.sleep(2)
+        status_data = poll_status(session, file_id, deadline=40.0, base_url=BASE_URL) or {}
+        status = status_data.get("status")
+        if status == "processed":
+            entities_count = status_data.get("entities_count", 0)
+            relationships_count = status_data.get("relationships_count", 0)
+            print(f"   SUCCESS! File processed with:")
+            print(f"     - {status_data.get('chunks_count', 0)} chunks")
+            print(f"     - {entities_count} entities")
+            print(f"     - {relationships_count} relationships\n")
+        elif status == "failed":
+            error = status_data.get("error", "Unknown error")
+            print(f"   FAILED: {error}\n")
+            return
         
         # 3. Get knowledge graph
         print("3. Retrieving knowledge graph...")
-        response = requests.get(
-            f"{BASE_URL}/graph/{file_id}",
-            headers={"user-id": USER_ID}
-        )
+        response = session.get(f"{BASE_URL}/graph/{file_id}")
         
         if response.status_code == 200:
             graph_data = response.json()
@@ -92,30 +80,31 @@ def test_kg_simple():
         
         for query in queries:
             print(f"\n   Query: {query}")
-            response = requests.post(
-                f"{BASE_URL}/query",
-                headers={"user-id": USER_ID, "Content-Type": "application/json"},
-                json={
+            result = cached_query(
+                session,
+                {
                     "query": query,
                     "file_id": file_id,
                     "session_id": "test_session",
                     "use_kg": True
-                }
+                },
+                base_url=BASE_URL
             )
             
-            if response.status_code == 200:
-                result = response.json()
+            if result is not None:
                 print(f"   Answer: {result['answer'][:200]}...")
                 print(f"   Sources: {len(result['sources'])}")
                 
-                # Print source types
-                kg_sources = [s for s in result['sources'] if s.get('source_type') == 'knowledge_graph']
-                vector_sources = [s for s in result['sources'] if s.get('source_type') == 'vector_search']
+                # Print source types, grouped in a single pass
+                buckets = defaultdict(list)
+                for s in result['sources']:
+                    buckets[s.get('source_type')].append(s)
+                kg_sources = buckets['knowledge_graph']
+                vector_sources = buckets['vector_search']
                 print(f"   Knowledge graph sources: {len(kg_sources)}")
                 print(f"   Vector search sources: {len(vector_sources)}")
             else:
-                print(f"   Query failed: {response.status_code}")
-                print(f"   {response.text}")
+                print("   Query failed")
         
         print("\nTest completed!")
         
@@ -125,4 +114,5 @@ def test_kg_simple():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    test_kg_simple()
+    with session:
+        test_kg_simple()
@@ -1,8 +1,7 @@
 """Test knowledge graph creation and hybrid retrieval."""
-import requests
-import time
-import json
+from _http import cached_get, cached_query, make_session, poll_status, upload_file
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -11,6 +10,8 @@ load_dotenv()
 BASE_URL = "http://localhost:8000"
 USER_ID = "test_user_123"
 
+session = make_session(USER_ID)
+
 def test_knowledge_graph():
     """Test uploading a PDF, creating a knowledge graph, and querying with hybrid retrieval."""
     print("Testing Knowledge Graph Creation and Hybrid Retrieval\n")
@@ -19,67 +20,45 @@ def test_knowledge_graph():
     pdf_file = "ai_analyst_newton.pdf"  # Replace with your actual PDF file name
     
     try:
-        with open(pdf_file, "rb") as f:
-            print(f"1. Uploading PDF: {pdf_file}")
-            response = requests.post(
-                f"{BASE_URL}/upload",
-                headers={"user-id": USER_ID},
-                files={"file": (pdf_file, f, "application/pdf")}
-            )
-            
-            if response.status_code != 200:
-                print(f"Upload failed: {response.status_code}")
-                print(response.text)
-                return
-            
-            result = response.json()
-            file_id = result["file_id"]
-            print(f"   File uploaded: {file_id}")
-            print(f"   Status: {result['status']}\n")
+        print(f"1. Uploading PDF: {pdf_file}")
+        response = upload_file(session, pdf_file, "application/pdf", base_url=BASE_URL)
+        
+        if response.status_code != 200:
+            print(f"Upload failed: {response.status_code}")
+            print(response.text)
+            return
+        
+        result = response.json()
+        file_id = result["file_id"]
+        print(f"   File uploaded: {file_id}")
+        print(f"   Status: {result['status']}\n")
         
         # 2. Check processing status (wait for knowledge graph creation)
         print("2. Checking processing status...")
-        status = ""
-        for i in range(30):  # Wait up to 60 seconds
-            response = requests.get(
-                f"{BASE_URL}/file/{file_id}/status",
-                headers={"user-id": USER_ID}
-            )
-            
-            status_data = response.json()
-            status = status_data.get("status")
-            print(f"   Attempt {i+1}: Status = {status}")
-            
-            if status == "processed":
-                entities_count = status_data.get("entities_count", 0)
-                relationships_count = status_data.get("relationships_count", 0)
-                print(f"   SUCCESS! File processed with:")
-                print(f"     - {status_data.get('chunks_count', 0)} chunks")
-                print(f"     - {entities_count} entities")
-                print(f"     - {relationships_count} relationships\n")
-                break
-            elif status == "failed":
-                error = status_data.get("error", "Unknown error")
-                print(f"   FAILED: {error}\n")
-                return
-            elif status == "building_graph":
-                print("   Building knowledge graph...\n")
-            
-            time.sleep(2)
-        else:
+        status_data = poll_status(session, file_id, deadline=60.0, base_url=BASE_URL)
+        if status_data is None:
             print("   Processing timed out\n")
             return
         
+        status = status_data.get("status")
+        if status == "processed":
+            entities_count = status_data.get("entities_count", 0)
+            relationships_count = status_data.get("relationships_count", 0)
+            print(f"   SUCCESS! File processed with:")
+            print(f"     - {status_data.get('chunks_count', 0)} chunks")
+            print(f"     - {entities_count} entities")
+            print(f"     - {relationships_count} relationships\n")
+        else:
+            error = status_data.get("error", "Unknown error")
+            print(f"   FAILED: {error}\n")
+            return
+        
         # 3. Get knowledge graph data
         if status == "processed":
             print("3. Retrieving knowledge graph...")
-            response = requests.get(
-                f"{BASE_URL}/graph/{file_id}",
-                headers={"user-id": USER_ID}
-            )
+            graph_data = cached_get(session, f"{BASE_URL}/graph/{file_id}")
             
-            if response.status_code == 200:
-                graph_data = response.json()
+            if graph_data is not None:
                 print(f"   Graph contains {len(graph_data['nodes'])} nodes and {len(graph_data['edges'])} edges")
                 
                 # Print some sample nodes
@@ -94,8 +73,7 @@ def test_knowledge_graph():
                     for edge in graph_data["edges"][:5]:
                         print(f"     - {edge['source']} {edge['label']} {edge['target']}")
             else:
-                print(f"   Failed to retrieve graph: {response.status_code}")
-                print(f"   {response.text}")
+                print("   Failed to retrieve graph")
         
         # 4. Test hybrid retrieval
         print("\n4. Testing hybrid retrieval...")
@@ -105,44 +83,39 @@ def test_knowledge_graph():
             "What are the key technologies mentioned?"
         ]
         
+        # Every query runs with and without the knowledge graph, all in flight at once
+        results = {}
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            futures = {
+                executor.submit(
+                    cached_query,
+                    session,
+                    {
+                        "query": query,
+                        "file_id": file_id,
+                        "session_id": "test_kg" if use_kg else "test_no_kg",
+                        "use_kg": use_kg
+                    },
+                    base_url=BASE_URL
+                ): (query, use_kg)
+                for query in queries for use_kg in (True, False)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        
         for query in queries:
             print(f"\n   Query: {query}")
+            result_kg = results[(query, True)]
+            result_no_kg = results[(query, False)]
             
-            # Test with knowledge graph
-            response_kg = requests.post(
-                f"{BASE_URL}/query",
-                headers={"user-id": USER_ID, "Content-Type": "application/json"},
-                json={
-                    "query": query,
-                    "file_id": file_id,
-                    "session_id": "test_kg",
-                    "use_kg": True
-                }
-            )
-            
-            # Test without knowledge graph
-            response_no_kg = requests.post(
-                f"{BASE_URL}/query",
-                headers={"user-id": USER_ID, "Content-Type": "application/json"},
-                json={
-                    "query": query,
-                    "file_id": file_id,
-                    "session_id": "test_no_kg",
-                    "use_kg": False
-                }
-            )
-            
-            if response_kg.status_code == 200 and response_no_kg.status_code == 200:
-                result_kg = response_kg.json()
-                result_no_kg = response_no_kg.json()
-                
+            if result_kg is not None and result_no_kg is not None:
                 print(f"   With KG: {len(result_kg['sources'])} sources")
                 print(f"   Without KG: {len(result_no_kg['sources'])} sources")
                 
                 print(f"   Answer with KG: {result_kg['answer'][:100]}...")
                 print(f"   Answer without KG: {result_no_kg['answer'][:100]}...")
             else:
-                print(f"   Query failed: KG={response_kg.status_code}, No KG={response_no_kg.status_code}")
+                print(f"   Query failed: KG={'ok' if result_kg else 'failed'}, No KG={'ok' if result_no_kg else 'failed'}")
         
         print("\nTest completed successfully!")
         
@@ -155,4 +128,5 @@ def test_knowledge_graph():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    test_knowledge_graph()
+    with session:
+        test_knowledge_graph()
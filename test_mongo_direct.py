@@ -1,36 +1,73 @@
 """Test MongoDB connection directly."""
+import atexit
 import os
 from pymongo import MongoClient
+from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
 
+# Load environment variables once, at import
+load_dotenv()
+MONGO_URI = os.getenv("MONGODB_URI")
+
+_client = None
+
+def get_client():
+    """Return the process-wide MongoClient, creating its pool on first use."""
+    global _client
+    if _client is None:
+        _client = MongoClient(
+            MONGO_URI,
+            maxPoolSize=20,
+            minPoolSize=2,
+            serverSelectionTimeoutMS=3000,
+            server_api=ServerApi("1")
+        )
+        atexit.register(_client.close)
+    return _client
+
 def test_mongo_direct():
     """Test MongoDB connection directly."""
     print("Testing MongoDB Connection Directly\n")
     
     try:
-        load_dotenv()
-        mongo_uri = os.getenv("MONGODB_URI")
-        print(f"MongoDB URI: {mongo_uri[:20] if mongo_uri else 'None'}...")
+        print(f"MongoDB URI: {MONGO_URI[:20] if MONGO_URI else 'None'}...")
         
-        client = MongoClient(mongo_uri)
+        client = get_client()
         db = client.brain
         
         print(f"Connected to database: {db.name}")
         print(f"Collections: {db.list_collection_names()}")
         
-        # Count total chunks
-        total_chunks = db.chunks.count_documents({})
-        print(f"Total chunks: {total_chunks}")
+        # Index both user-id spellings so the per-user lookups below are index scans
+        db.chunks.create_index("userId")
+        db.chunks.create_index("user_id")
         
-        # Count user chunks (both formats)
+        # Count total chunks from collection metadata rather than a scan
+        total_chunks = db.chunks.estimated_document_count()
+        print(f"Total chunks (estimated): {total_chunks}")
+        
+        # Count user chunks (both formats) in one aggregation
         user_id = "u1"
-        user_chunks_camel = db.chunks.count_documents({"userId": user_id})
-        user_chunks_snake = db.chunks.count_documents({"user_id": user_id})
+        counts = {
+            group["_id"]: group["n"]
+            for group in db.chunks.aggregate([
+                {"$match": {"$or": [{"userId": user_id}, {"user_id": user_id}]}},
+                {"$group": {
+                    "_id": {"$cond": [{"$eq": [{"$type": "$userId"}, "missing"]}, "snake_case", "camelCase"]},
+                    "n": {"$sum": 1}
+                }}
+            ])
+        }
+        user_chunks_camel = counts.get("camelCase", 0)
+        user_chunks_snake = counts.get("snake_case", 0)
         print(f"Chunks for user '{user_id}' (camelCase): {user_chunks_camel}")
         print(f"Chunks for user '{user_id}' (snake_case): {user_chunks_snake}")
         
-        # Get all chunks for user (camelCase)
-        chunks = list(db.chunks.find({"userId": user_id}))
+        # Get a sample of chunks for user (camelCase), only the printed fields
+        chunks = list(db.chunks.find(
+            {"userId": user_id},
+            projection={"chunkId": 1, "text": 1, "meta": 1, "_id": 0}
+        ).hint("userId_1").limit(20))
         print(f"Found {len(chunks)} chunks for user '{user_id}'")
         
         for i, chunk in enumerate(chunks):
@@ -39,8 +76,6 @@ def test_mongo_direct():
             print(f"  Text: {chunk.get('text', 'NO_TEXT')[:100]}...")
             print(f"  Meta: {chunk.get('meta', {})}")
         
-        client.close()
-        
     except Exception as e:
         print(f"ERROR: {e}")
         import traceback
@@ -1,11 +1,13 @@
 """Test PDF upload and processing."""
-import requests
-import time
+from _http import cached_query, make_session, poll_status, upload_file
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 BASE_URL = "http://localhost:8000"
 USER_ID = "test_user_123"
 
+session = make_session(USER_ID)
+
 def test_pdf_upload():
     """Test uploading and querying a PDF file."""
     print("Testing PDF Upload and Processing\n")
@@ -14,50 +16,34 @@ def test_pdf_upload():
     pdf_file = "ai_analyst_newton.pdf"  # Replace with your actual PDF file name
     
     try:
-        with open(pdf_file, "rb") as f:
-            print(f"1. Uploading PDF: {pdf_file}")
-            response = requests.post(
-                f"{BASE_URL}/upload",
-                headers={"user-id": USER_ID},
-                files={"file": (pdf_file, f, "application/pdf")}
-            )
-            
-            if response.status_code != 200:
-                print(f"Upload failed: {response.status_code}")
-                print(response.text)
-                return
-            
-            result = response.json()
-            file_id = result["file_id"]
-            print(f"   File uploaded: {file_id}")
-            print(f"   Status: {result['status']}\n")
+        print(f"1. Uploading PDF: {pdf_file}")
+        response = upload_file(session, pdf_file, "application/pdf", base_url=BASE_URL)
+        
+        if response.status_code != 200:
+            print(f"Upload failed: {response.status_code}")
+            print(response.text)
+            return
+        
+        result = response.json()
+        file_id = result["file_id"]
+        print(f"   File uploaded: {file_id}")
+        print(f"   Status: {result['status']}\n")
         
         # 2. Check processing status
         print("2. Checking processing status...")
-        for i in range(20):  # Wait up to 40 seconds
-            response = requests.get(
-                f"{BASE_URL}/file/{file_id}/status",
-                headers={"user-id": USER_ID}
-            )
-            
-            status_data = response.json()
-            status = status_data.get("status")
-            print(f"   Attempt {i+1}: Status = {status}")
-            
-            if status == "processed":
-                chunks_count = status_data.get("chunks_count", 0)
-                print(f"   SUCCESS! File processed with {chunks_count} chunks\n")
-                break
-            elif status == "failed":
-                error = status_data.get("error", "Unknown error")
-                print(f"   FAILED: {error}\n")
-                return
-            
-            time.sleep(2)
-        else:
+        status_data = poll_status(session, file_id, deadline=40.0, base_url=BASE_URL)
+        if status_data is None:
             print("   Processing timed out\n")
             return
         
+        if status_data.get("status") == "failed":
+            error = status_data.get("error", "Unknown error")
+            print(f"   FAILED: {error}\n")
+            return
+        
+        chunks_count = status_data.get("chunks_count", 0)
+        print(f"   SUCCESS! File processed with {chunks_count} chunks\n")
+        
         # 3. Query the PDF
         print("3. Querying the PDF...")
         queries = [
@@ -66,35 +52,40 @@ def test_pdf_upload():
             "What are the key findings?"
         ]
         
+        results = {}
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            futures = {
+                executor.submit(
+                    cached_query,
+                    session,
+                    {
+                        "query": query,
+                        "file_id": file_id,
+                        "session_id": "test_session_1"
+                    },
+                    base_url=BASE_URL
+                ): query
+                for query in queries
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        
         for query in queries:
             print(f"\n   Query: {query}")
-            response = requests.post(
-                f"{BASE_URL}/query",
-                headers={"user-id": USER_ID, "Content-Type": "application/json"},
-                json={
-                    "query": query,
-                    "file_id": file_id,
-                    "session_id": "test_session_1"
-                }
-            )
+            result = results[query]
             
-            if response.status_code == 200:
-                result = response.json()
+            if result is not None:
                 answer = result["answer"]
                 sources = result["sources"]
                 
                 print(f"   Answer: {answer[:200]}...")
                 print(f"   Sources: {len(sources)} chunks used")
             else:
-                print(f"   Query failed: {response.status_code}")
-                print(f"   {response.text}")
+                print("   Query failed")
         
         # 4. Get chat history
         print("\n4. Getting chat history...")
-        response = requests.get(
-            f"{BASE_URL}/chat-history/{file_id}",
-            headers={"user-id": USER_ID}
-        )
+        response = session.get(f"{BASE_URL}/chat-history/{file_id}")
         
         if response.status_code == 200:
             history = response.json()
@@ -111,5 +102,6 @@ def test_pdf_upload():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    test_pdf_upload()
+    with session:
+        test_pdf_upload()
 
@@ -1,44 +1,45 @@
 """Test if server is running updated code."""
-import requests
-import json
+from _http import make_session
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+session = make_session("u1", header="x-user-id")
+# Set TEST_DEBUG=1 to print full response bodies
+DEBUG = os.getenv("TEST_DEBUG") == "1"
 
 def test_server_code():
     """Test if server is running updated code."""
     print("Testing Server Code Version\n")
     
     base_url = "http://localhost:8082"
-    headers = {"x-user-id": "u1", "Content-Type": "application/json"}
+    
+    # The three searches are independent, so they go out as one concurrent burst
+    checks = [
+        ("Testing search endpoint", {"query": "test", "k": 1}),
+        ("Testing with empty query", {"query": "", "k": 1}),
+        ("Testing with non-existent query", {"query": "xyz123nonexistent", "k": 1}),
+    ]
     
     try:
-        # Test search with debug info
-        print("1. Testing search endpoint...")
-        search_data = {"query": "test", "k": 1}
-        response = requests.post(f"{base_url}/api/search", 
-                               headers=headers, 
-                               json=search_data)
-        print(f"Status: {response.status_code}")
-        print(f"Response: {response.text}")
-        
-        # Test with empty query
-        print("\n2. Testing with empty query...")
-        search_data2 = {"query": "", "k": 1}
-        response2 = requests.post(f"{base_url}/api/search", 
-                                headers=headers, 
-                                json=search_data2)
-        print(f"Status: {response2.status_code}")
-        print(f"Response: {response2.text}")
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            responses = list(executor.map(
+                lambda search_data: session.post(f"{base_url}/api/search", json=search_data),
+                [search_data for _, search_data in checks]
+            ))
         
-        # Test with non-existent query
-        print("\n3. Testing with non-existent query...")
-        search_data3 = {"query": "xyz123nonexistent", "k": 1}
-        response3 = requests.post(f"{base_url}/api/search", 
-                                headers=headers, 
-                                json=search_data3)
-        print(f"Status: {response3.status_code}")
-        print(f"Response: {response3.text}")
+        for i, ((label, _), response) in enumerate(zip(checks, responses)):
+            if i:
+                print()
+            print(f"{i+1}. {label}...")
+            print(f"Status: {response.status_code}")
+            if DEBUG:
+                print(f"Response: {response.text}")
+            else:
+                print(f"Response: {len(response.content)} bytes")
         
     except Exception as e:
         print(f"ERROR: {e}")
 
 if __name__ == "__main__":
-    test_server_code()
+    with session:
+        test_server_code()
@@ -1,22 +1,22 @@
 """Test the simplified knowledge graph approach."""
-import requests
+from _http import cached_query, make_session, poll_status, upload_file
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
 
 BASE_URL = "http://localhost:8000"
 USER_ID = "test_user_123"
 
+session = make_session(USER_ID)
+
 def test_simplified_kg():
     """Test the simplified knowledge graph approach."""
     print("Testing Simplified Knowledge Graph Approach\n")
     
     # 1. Upload a test file
     print("1. Uploading test file...")
-    with open("test-kg.txt", "rb") as f:
-        response = requests.post(
-            f"{BASE_URL}/upload",
-            headers={"user-id": USER_ID},
-            files={"file": ("test-kg.txt", f)}
-        )
+    response = upload_file(session, "test-kg.txt", "text/plain", base_url=BASE_URL)
     
     if response.status_code != 200:
         print(f"Upload failed: {response.status_code}")
@@ -28,25 +28,14 @@ def test_simplified_kg():
     
     # 2. Wait for processing to complete
     print("\n2. Waiting for processing to complete...")
-    for i in range(15):  # Wait up to 30 seconds
-        response = requests.get(
-            f"{BASE_URL}/file/{file_id}/status",
-            headers={"user-id": USER_ID}
-        )
-        
-        status = response.json().get("status")
-        print(f"Status: {status}")
-        
-        if status == "processed":
-            print(f"Processing complete with {response.json().get('chunks_count', 0)} chunks")
-            print(f"Knowledge graph: {response.json().get('entities_count', 0)} entities, {response.json().get('relationships_count', 0)} relationships")
-            break
-        elif status == "failed":
-            print(f"Processing failed: {response.json().get('error', 'Unknown error')}")
-            return
-        
-        import time
-        time.sleep(2)
+    status_data = poll_status(session, file_id, deadline=30.0, base_url=BASE_URL) or {}
+    status = status_data.get("status")
+    if status == "processed":
+        print(f"Processing complete with {status_data.get('chunks_count', 0)} chunks")
+        print(f"Knowledge graph: {status_data.get('entities_count', 0)} entities, {status_data.get('relationships_count', 0)} relationships")
+    elif status == "failed":
+        print(f"Processing failed: {status_data.get('error', 'Unknown error')}")
+        return
     
     # 3. Test queries with knowledge graph
     print("\n3. Testing queries with knowledge graph...")
@@ -57,41 +46,55 @@ def test_simplified_kg():
         "What is BERT used for?"
     ]
     
+    # Test with knowledge graph, all queries in flight at once
+    results = {}
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {
+            executor.submit(
+                cached_query,
+                session,
+                {
+                    "query": query,
+                    "file_id": file_id,
+                    "session_id": "test_kg",
+                    "use_kg": True,
+                    # Only the first 100 characters of each source are printed
+                    "max_chars": 100
+                },
+                base_url=BASE_URL
+            ): query
+            for query in test_queries
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    
     for query in test_queries:
         print(f"\nQuery: {query}")
+        result = results[query]
         
-        # Test with knowledge graph
-        response = requests.post(
-            f"{BASE_URL}/query",
-            headers={"user-id": USER_ID, "Content-Type": "application/json"},
-            json={
-                "query": query,
-                "file_id": file_id,
-                "session_id": "test_kg",
-                "use_kg": True
-            }
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            
-            # Count sources by type
-            kg_sources = [s for s in result["sources"] if s.get("source_type") == "knowledge_graph"]
-            vector_sources = [s for s in result["sources"] if s.get("source_type") == "vector_search"]
+        if result is not None:
+            # Collect source types and format lines in one pass, then count types in NumPy
+            source_types = []
+            lines = []
+            for i, source in enumerate(result["sources"]):
+                source_type = source.get("source_type", "?")
+                source_types.append(source_type)
+                lines.append(f"  {i+1}. [{source_type}] {source['text'][:100]}...")
+            types, type_counts = np.unique(np.array(source_types, dtype=str), return_counts=True)
+            counts = dict(zip(types.tolist(), type_counts.tolist()))
             
             print(f"Answer: {result['answer'][:100]}...")
-            print(f"Knowledge graph sources: {len(kg_sources)}")
-            print(f"Vector search sources: {len(vector_sources)}")
+            print(f"Knowledge graph sources: {counts.get('knowledge_graph', 0)}")
+            print(f"Vector search sources: {counts.get('vector_search', 0)}")
             
             # Print the sources
             print("\nSources:")
-            for i, source in enumerate(result["sources"]):
-                print(f"  {i+1}. [{source['source_type']}] {source['text'][:100]}...")
+            print("\n".join(lines))
         else:
-            print(f"Query failed: {response.status_code}")
-            print(response.text)
+            print("Query failed")
     
     print("\nTest completed!")
 
 if __name__ == "__main__":
-    test_simplified_kg()
+    with session:
+        test_simplified_kg()
@@ -0,0 +1,16 @@
+"""Shared pytest configuration."""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """One event loop for the session, as long-lived as the shared embeddings client.
+    
+    Its pooled async connections are bound to the loop that opened them, so a fresh
+    loop per test would leave the next test reusing connections on a closed loop.
+    """
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
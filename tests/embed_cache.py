@@ -0,0 +1,54 @@
+"""Content-addressed embedding cache shared by the test runs."""
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+# One .npy file per input text, named by the SHA-256 of the text
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".embed_cache")
+
+_memory = {}
+_lock = threading.RLock()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, f"{key}.npy")
+
+
+def cache_key(text):
+    """SHA-256 hex digest the cached vector for text is stored under."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def lookup(text):
+    """Return the cached float32 vector for text, or None if it was never embedded."""
+    key = cache_key(text)
+    with _lock:
+        vec = _memory.get(key)
+        if vec is None and os.path.exists(_path(key)):
+            vec = _memory[key] = np.load(_path(key))
+    return vec
+
+
+def store(text, vec):
+    """Cache an embedding for text and return it as a float32 array."""
+    key = cache_key(text)
+    vec = np.asarray(vec, dtype=np.float32)
+    with _lock:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write then rename, so another process never loads a partial file
+        tmp_path = f"{_path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, vec)
+        os.replace(tmp_path, _path(key))
+        _memory[key] = vec
+    return vec
+
+
+def get_or_embed(text, embed_fn):
+    """Return the cached embedding for text, calling embed_fn(text) only on a miss."""
+    vec = lookup(text)
+    if vec is None:
+        vec = store(text, embed_fn(text))
+    return vec
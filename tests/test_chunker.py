@@ -0,0 +1,34 @@
+"""Test token-window chunking in simple_app."""
+from simple_app import CHUNK_OVERLAP_TOKENS, CHUNK_TOKENS, TIKTOKEN_SUPPORT, TextChunker, split_into_chunks
+
+TEXT = " ".join(f"word{i}" for i in range(2000))
+
+
+class TestTextChunker:
+    """Test the streaming TextChunker."""
+    
+    def test_builds_encoding(self):
+        """Test that the chunker can be constructed with the pinned tokenizer."""
+        chunker = TextChunker()
+        
+        if TIKTOKEN_SUPPORT:
+            assert chunker.encoding is not None
+            assert (chunker.size, chunker.overlap) == (CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+    
+    def test_windows(self):
+        """Test that windows respect the size and cover the whole text."""
+        chunker = TextChunker()
+        chunks = split_into_chunks(TEXT)
+        
+        assert len(chunks) > 1
+        if chunker.encoding:
+            assert all(len(chunker.encoding.encode(chunk)) <= CHUNK_TOKENS for chunk in chunks)
+        assert chunks[0].startswith("word0")
+        assert chunks[-1].endswith("word1999")
+
+
+if __name__ == "__main__":
+    test = TestTextChunker()
+    test.test_builds_encoding()
+    test.test_windows()
+    print("✅ All tests passed!")
@@ -1,59 +1,211 @@
 """Test RAG functionality."""
+import functools
+import hashlib
+import os
+
+import faiss
+import numpy as np
 import pytest
 import asyncio
 from services.ingest import IngestService
 from services.search import SearchService
 from services.chat import ChatService
+from tests import embed_cache
+
+# Batched searches are split across OpenMP threads; cap them for shared CI machines
+faiss.omp_set_num_threads(min(os.cpu_count() or 1, 8))
+
+CHUNKING_TEXTS = [
+    "This is a test document. It has multiple sentences. Each sentence should be chunked properly.",
+    "Short paragraph one.\n\nShort paragraph two.\n\nShort paragraph three.",
+    "AI is transforming how we work.\n\nMachine learning learns from data.\n\nDeep learning stacks layers."
+]
+
+EMBEDDING_TEXTS = [
+    "This is a test sentence.",
+    "What is artificial intelligence?",
+    "Neural networks are loosely inspired by the brain."
+]
+
+SEARCH_QUERIES = [
+    "What is AI?",
+    "How do machines learn from data?",
+    "What are neural networks?"
+]
+
+# Index into DOCUMENT_TEXTS of the document each search query should rank first
+SEARCH_TOP_HITS = [0, 1, 2]
+
+DOCUMENT_TEXTS = [
+    "Artificial intelligence is a branch of computer science.",
+    "Machine learning is a subset of artificial intelligence.",
+    "Deep learning uses neural networks with multiple layers."
+]
+
+
+@functools.lru_cache(maxsize=1)
+def _splitter():
+    """Module-wide text splitter, configured once and reused for every input."""
+    from langchain.text_splitter import CharacterTextSplitter
+    
+    return CharacterTextSplitter(chunk_size=50, chunk_overlap=10)
+
+
+@pytest.fixture(scope="module")
+def splitter():
+    """Text splitter shared by every chunking case."""
+    return _splitter()
+
+
+@functools.lru_cache(maxsize=1)
+def _embeddings():
+    """Module-wide embeddings client, built once and reused by every test."""
+    import httpx
+    from langchain_openai import OpenAIEmbeddings
+    
+    # chunk_size batches up to 1000 inputs into each embeddings request. The sync and
+    # async OpenAI clients each need their own HTTP/2 pool to keep connections alive.
+    return OpenAIEmbeddings(
+        chunk_size=1000,
+        http_client=httpx.Client(http2=True),
+        http_async_client=httpx.AsyncClient(http2=True)
+    )
+
+
+@pytest.fixture(scope="session")
+def embeddings():
+    """Embeddings client shared by every test, one per xdist worker."""
+    return _embeddings()
+
+
+def ivfpq_index_path(model, texts):
+    """Cache file for the trained IVF+PQ index over texts, named by a SHA-256 of model and texts.
+    
+    Changing the document texts or the embedding model gives a new file, never a stale index.
+    Texts are hashed rather than vectors, which can differ in the last bits between API calls.
+    """
+    digest = hashlib.sha256("\0".join([model, *texts]).encode()).hexdigest()
+    return os.path.join(os.path.dirname(__file__), f".faiss_index.{digest}.ivfpq")
+
+
+async def embed_query_cached(embeddings, text):
+    """Embed a query as a float32 vector, reusing the cached vector for text already embedded."""
+    vec = embed_cache.lookup(text)
+    if vec is None:
+        vec = embed_cache.store(text, await embeddings.aembed_query(text))
+    return vec
 
 
 class TestRAG:
     """Test RAG pipeline."""
     
-    def test_chunking(self):
+    @pytest.mark.parametrize("text", CHUNKING_TEXTS)
+    def test_chunking(self, splitter, text):
         """Test text chunking."""
-        from langchain.text_splitter import CharacterTextSplitter
-        
-        text = "This is a test document. It has multiple sentences. Each sentence should be chunked properly."
-        splitter = CharacterTextSplitter(chunk_size=50, chunk_overlap=10)
         chunks = splitter.split_text(text)
         
         assert len(chunks) > 0
-        assert all(len(chunk) <= 50 for chunk in chunks)
+        lengths = np.fromiter(map(len, chunks), dtype=np.int32, count=len(chunks))
+        assert lengths.max() <= 50
     
-    def test_embeddings(self):
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("text", EMBEDDING_TEXTS)
+    async def test_embeddings(self, embeddings, text):
         """Test embedding generation."""
-        from langchain.embeddings import OpenAIEmbeddings
+        # Contiguous float32, the layout FAISS consumes, instead of a list of Python floats
+        vec = np.asarray(await embed_query_cached(embeddings, text), dtype=np.float32)
         
-        embeddings = OpenAIEmbeddings()
-        text = "This is a test sentence."
-        embedding = embeddings.embed_query(text)
-        
-        assert len(embedding) == 1536  # OpenAI text-embedding-3-small dimension
-        assert all(isinstance(x, float) for x in embedding)
+        assert vec.shape == (1536,)  # OpenAI text-embedding-3-small dimension
+        assert vec.dtype == np.float32
     
-    def test_vector_search(self):
+    @pytest.mark.asyncio
+    async def test_vector_search(self, embeddings):
         """Test vector search."""
-        from langchain.embeddings import OpenAIEmbeddings
-        from langchain.vectorstores import FAISS
-        from langchain.schema import Document
-        
-        # Create test documents
-        documents = [
-            Document(page_content="Artificial intelligence is a branch of computer science."),
-            Document(page_content="Machine learning is a subset of artificial intelligence."),
-            Document(page_content="Deep learning uses neural networks with multiple layers.")
-        ]
+        # Document texts stay in a plain list; FAISS ids index into it directly
+        texts = list(DOCUMENT_TEXTS)
+        documents, *queries = await asyncio.gather(
+            embeddings.aembed_documents(texts),
+            *(embed_query_cached(embeddings, query) for query in SEARCH_QUERIES)
+        )
+        vectors = np.asarray(documents, dtype=np.float32)
+        # All queries go to FAISS as one (B, dim) matrix
+        queries = np.vstack(queries).astype(np.float32)
         
-        # Create vector store
-        embeddings = OpenAIEmbeddings()
-        vectorstore = FAISS.from_documents(documents, embeddings)
+        # Inner product over L2-normalized vectors is cosine similarity. HNSW so the
+        # test exercises the ANN path instead of a flat scan.
+        faiss.normalize_L2(vectors)
+        faiss.normalize_L2(queries)
+        index = faiss.IndexHNSWFlat(vectors.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 40
+        index.hnsw.efSearch = 16
+        index.add(vectors)
         
         # Test search
-        query = "What is AI?"
-        results = vectorstore.similarity_search(query, k=2)
+        _, ids = index.search(queries, 2)
         
-        assert len(results) == 2
-        assert all(isinstance(doc, Document) for doc in results)
+        assert ids.shape == (len(SEARCH_QUERIES), 2)
+        # A miss is -1, which would still index a valid text, so check ids before using them
+        assert (ids >= 0).all()
+        assert ids[:, 0].tolist() == SEARCH_TOP_HITS
+    
+    @pytest.mark.asyncio
+    async def test_quantized_vector_search(self, embeddings):
+        """Test vector search over an IVF+PQ index."""
+        # Document and query embeddings are independent requests, so they overlap
+        documents, query = await asyncio.gather(
+            embeddings.aembed_documents(DOCUMENT_TEXTS),
+            embed_query_cached(embeddings, "What is AI?")
+        )
+        vectors = np.asarray(documents, dtype=np.float32)
+        query = query.reshape(1, -1)
+        dim = vectors.shape[1]
+        
+        index_path = ivfpq_index_path(embeddings.model, DOCUMENT_TEXTS)
+        if os.path.exists(index_path):
+            # Memory-mapped: pages are faulted in on demand instead of read up front
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+        else:
+            # nlist=4 inverted lists, 16 sub-vectors of 8 bits each (16 bytes per vector).
+            # PQ needs 256+ training points per sub-quantizer, so train on a synthetic corpus.
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, 4, 16, 8)
+            rng = np.random.default_rng(0)
+            training = rng.standard_normal((1024, dim)).astype(np.float32) * vectors.std()
+            index.train(np.vstack([training, vectors]))
+            index.add(vectors)
+            # Write then rename, so a concurrent xdist worker never reads a partial file
+            tmp_path = f"{index_path}.{os.getpid()}"
+            faiss.write_index(index, tmp_path)
+            os.replace(tmp_path, index_path)
+        index.nprobe = 4
+        
+        distances, ids = index.search(query, 2)
+        
+        assert ids.shape == (1, 2)
+        assert all(0 <= i < len(DOCUMENT_TEXTS) for i in ids[0])
+    
+    @pytest.mark.asyncio
+    async def test_scalar_quantized_search(self, embeddings):
+        """Test that an SQ8 index finds the same top-2 documents as a flat index."""
+        documents, query = await asyncio.gather(
+            embeddings.aembed_documents(DOCUMENT_TEXTS),
+            embed_query_cached(embeddings, "What is AI?")
+        )
+        vectors = np.asarray(documents, dtype=np.float32)
+        dim = vectors.shape[1]
+        query = query.reshape(1, -1)
+        
+        flat = faiss.IndexFlatL2(dim)
+        flat.add(vectors)
+        _, flat_ids = flat.search(query, 2)
+        
+        # 8 bits per dimension from per-dimension min/max: 4x smaller than float32
+        sq = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+        sq.train(vectors)
+        sq.add(vectors)
+        _, sq_ids = sq.search(query, 2)
+        
+        assert set(sq_ids[0]) == set(flat_ids[0])
     
     def test_chat_service(self):
         """Test chat service."""
@@ -63,11 +215,22 @@ class TestRAG:
         assert chat_service is not None
 
 
+async def _run_async_tests(test, embeddings):
+    """Run the network-bound tests concurrently."""
+    await asyncio.gather(
+        *(test.test_embeddings(embeddings, text) for text in EMBEDDING_TEXTS),
+        test.test_vector_search(embeddings),
+        test.test_quantized_vector_search(embeddings),
+        test.test_scalar_quantized_search(embeddings)
+    )
+
+
 if __name__ == "__main__":
     # Run basic tests
     test = TestRAG()
-    test.test_chunking()
-    test.test_embeddings()
-    test.test_vector_search()
+    embeddings = _embeddings()
+    for text in CHUNKING_TEXTS:
+        test.test_chunking(_splitter(), text)
+    asyncio.run(_run_async_tests(test, embeddings))
     test.test_chat_service()
     print("✅ All tests passed!")